@@ -1,8 +1,13 @@
 import logging
 import asyncio
+import json
 import hashlib
+import shlex
+from functools import lru_cache
 from aiogram import types
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+from ssh_manager import get_live_session, execute_ssh_command, run_ssh_command, run_blocking
+from file_manager import get_server_cached, escape_html
 
 logger = logging.getLogger(__name__)
 
@@ -27,6 +32,11 @@ def get_cached_callback_data(identifier):
     """Get callback data from cache or return identifier if not cached"""
     return callback_cache.get(identifier, identifier)
 
+@lru_cache(maxsize=1024)
+def back_keyboard(text, callback_data):
+    """Keyboard with a single back button, shared between messages"""
+    return InlineKeyboardMarkup().add(InlineKeyboardButton(text, callback_data=callback_data))
+
 def init_bot_manager(dp, bot, active_sessions, user_input):
     """Initialize bot manager handlers"""
     
@@ -89,9 +99,18 @@ def init_bot_manager(dp, bot, active_sessions, user_input):
     
     async def get_ssh_session(server_id):
         """Get SSH session for server"""
-        if server_id in active_sessions:
-            return active_sessions[server_id]
-        return None
+        return await run_blocking(get_live_session, server_id)
+    
+    def quoted_target(bot_info):
+        """Shell-quoted name and PID of a managed bot, both originate from remote output"""
+        return shlex.quote(bot_info['name']), shlex.quote(str(bot_info.get('pid', '0')))
+    
+    async def run_command(ssh, command):
+        """Run a command on the SSH worker pool and return its stripped stdout"""
+        stdout, error = await run_blocking(execute_ssh_command, ssh, command)
+        if error:
+            logger.warning("Command %r failed: %s", command, error.strip())
+        return stdout.strip()
     
     def get_managed_bots(server_id):
         """Get manually managed bots for server"""
@@ -129,8 +148,7 @@ def init_bot_manager(dp, bot, active_sessions, user_input):
             
             if service_type == 'systemd':
                 # Get all systemd services
-                stdin, stdout, stderr = ssh.exec_command("systemctl list-units --type=service --all --no-pager --no-legend")
-                output = stdout.read().decode().strip()
+                output = await run_command(ssh, "systemctl list-units --type=service --all --no-pager --no-legend")
                 
                 for line in output.splitlines():
                     if line.strip():
@@ -147,8 +165,7 @@ def init_bot_manager(dp, bot, active_sessions, user_input):
             
             elif service_type == 'docker':
                 # Get all Docker containers
-                stdin, stdout, stderr = ssh.exec_command("docker ps -a --format 'table {{.Names}}\t{{.Status}}\t{{.Image}}' 2>/dev/null")
-                output = stdout.read().decode().strip()
+                output = await run_command(ssh, "docker ps -a --format 'table {{.Names}}\t{{.Status}}\t{{.Image}}' 2>/dev/null")
                 
                 for line in output.splitlines()[1:]:  # Skip header
                     if line.strip():
@@ -167,11 +184,9 @@ def init_bot_manager(dp, bot, active_sessions, user_input):
             
             elif service_type == 'pm2':
                 # Get all PM2 processes
-                stdin, stdout, stderr = ssh.exec_command("pm2 jlist 2>/dev/null")
-                output = stdout.read().decode().strip()
+                output = await run_command(ssh, "pm2 jlist 2>/dev/null")
                 
                 if output and output != '[]':
-                    import json
                     try:
                         processes = json.loads(output)
                         for proc in processes:
@@ -181,10 +196,9 @@ def init_bot_manager(dp, bot, active_sessions, user_input):
                                 'type': 'pm2',
                                 'pid': proc.get('pid')
                             })
-                    except:
+                    except (ValueError, TypeError, AttributeError):
                         # Fallback to text parsing
-                        stdin, stdout, stderr = ssh.exec_command("pm2 list --no-color 2>/dev/null")
-                        output = stdout.read().decode().strip()
+                        output = await run_command(ssh, "pm2 list --no-color 2>/dev/null")
                         
                         for line in output.splitlines():
                             if '│' in line and 'name' not in line.lower():
@@ -201,8 +215,7 @@ def init_bot_manager(dp, bot, active_sessions, user_input):
             
             elif service_type == 'processes':
                 # Get running processes
-                stdin, stdout, stderr = ssh.exec_command("ps aux | grep -E '(python|node|npm|java|go)' | grep -v grep")
-                output = stdout.read().decode().strip()
+                output = await run_command(ssh, "ps aux | grep -E '(python|node|npm|java|go)' | grep -v grep")
                 
                 for line in output.splitlines():
                     if line.strip():
@@ -225,7 +238,7 @@ def init_bot_manager(dp, bot, active_sessions, user_input):
             return services
             
         except Exception as e:
-            logger.error(f"Error discovering {service_type} services: {e}")
+            logger.error("Error discovering %s services: %s", service_type, e)
             return []
     
     async def get_bot_details(server_id, bot_id):
@@ -241,26 +254,22 @@ def init_bot_manager(dp, bot, active_sessions, user_input):
                         return bot_info
                     
                     bot_type = bot_info['type']
-                    bot_name = bot_info['name']
+                    quoted_name, quoted_pid = quoted_target(bot_info)
                     
                     if bot_type == 'systemd':
-                        stdin, stdout, stderr = ssh.exec_command(f"systemctl is-active {bot_name} 2>/dev/null || echo 'inactive'")
-                        status = stdout.read().decode().strip()
+                        status = await run_command(ssh, f"systemctl is-active {quoted_name} 2>/dev/null || echo 'inactive'")
                         bot_info['status'] = 'running' if status == 'active' else 'stopped'
                         
                     elif bot_type == 'docker':
-                        stdin, stdout, stderr = ssh.exec_command(f"docker inspect --format='{{{{.State.Status}}}}' {bot_name} 2>/dev/null || echo 'not found'")
-                        status = stdout.read().decode().strip()
+                        status = await run_command(ssh, f"docker inspect --format='{{{{.State.Status}}}}' {quoted_name} 2>/dev/null || echo 'not found'")
                         bot_info['status'] = 'running' if status == 'running' else 'stopped'
                         
                     elif bot_type == 'pm2':
-                        stdin, stdout, stderr = ssh.exec_command(f"pm2 describe {bot_name} --no-color 2>/dev/null | grep 'status' || echo 'status: stopped'")
-                        output = stdout.read().decode().strip()
+                        output = await run_command(ssh, f"pm2 describe {quoted_name} --no-color 2>/dev/null | grep 'status' || echo 'status: stopped'")
                         bot_info['status'] = 'running' if 'online' in output else 'stopped'
                         
                     elif bot_type == 'process':
-                        stdin, stdout, stderr = ssh.exec_command(f"ps -p {bot_info.get('pid', '0')} > /dev/null 2>&1 && echo 'running' || echo 'stopped'")
-                        status = stdout.read().decode().strip()
+                        status = await run_command(ssh, f"ps -p {quoted_pid} > /dev/null 2>&1 && echo 'running' || echo 'stopped'")
                         bot_info['status'] = status
                     
                     return bot_info
@@ -268,7 +277,7 @@ def init_bot_manager(dp, bot, active_sessions, user_input):
             return None
 
         except Exception as e:
-            logger.error(f"Error getting bot details for {bot_id}: {e}")
+            logger.error("Error getting bot details for %s: %s", bot_id, e)
             return None
     
     async def control_bot(server_id, bot_id, action):
@@ -290,51 +299,51 @@ def init_bot_manager(dp, bot, active_sessions, user_input):
                 return False, "Bot not found in managed list"
             
             bot_type = bot_info['type']
-            bot_name = bot_info['name']
+            quoted_name, quoted_pid = quoted_target(bot_info)
             
             if bot_type == 'systemd':
                 if action == 'start':
-                    stdin, stdout, stderr = ssh.exec_command(f"sudo systemctl start {bot_name}")
+                    command = f"sudo systemctl start {quoted_name}"
                 elif action == 'stop':
-                    stdin, stdout, stderr = ssh.exec_command(f"sudo systemctl stop {bot_name}")
+                    command = f"sudo systemctl stop {quoted_name}"
                 elif action == 'restart':
-                    stdin, stdout, stderr = ssh.exec_command(f"sudo systemctl restart {bot_name}")
+                    command = f"sudo systemctl restart {quoted_name}"
                     
             elif bot_type == 'docker':
                 if action == 'start':
-                    stdin, stdout, stderr = ssh.exec_command(f"docker start {bot_name}")
+                    command = f"docker start {quoted_name}"
                 elif action == 'stop':
-                    stdin, stdout, stderr = ssh.exec_command(f"docker stop {bot_name}")
+                    command = f"docker stop {quoted_name}"
                 elif action == 'restart':
-                    stdin, stdout, stderr = ssh.exec_command(f"docker restart {bot_name}")
+                    command = f"docker restart {quoted_name}"
                     
             elif bot_type == 'pm2':
                 if action == 'start':
-                    stdin, stdout, stderr = ssh.exec_command(f"pm2 start {bot_name}")
+                    command = f"pm2 start {quoted_name}"
                 elif action == 'stop':
-                    stdin, stdout, stderr = ssh.exec_command(f"pm2 stop {bot_name}")
+                    command = f"pm2 stop {quoted_name}"
                 elif action == 'restart':
-                    stdin, stdout, stderr = ssh.exec_command(f"pm2 restart {bot_name}")
+                    command = f"pm2 restart {quoted_name}"
                     
             elif bot_type == 'process':
                 if action == 'stop':
-                    stdin, stdout, stderr = ssh.exec_command(f"kill {bot_info.get('pid', '0')}")
+                    command = f"kill {quoted_pid}"
                 elif action == 'start':
                     if 'command' in bot_info:
-                        stdin, stdout, stderr = ssh.exec_command(f"nohup {bot_info['command']} > /dev/null 2>&1 &")
+                        command = f"nohup {bot_info['command']} > /dev/null 2>&1 &"
                     else:
                         return False, "No start command available for this process"
                 elif action == 'restart':
-                    stdin, stdout, stderr = ssh.exec_command(f"kill {bot_info.get('pid', '0')}")
+                    await run_command(ssh, f"kill {quoted_pid}")
                     await asyncio.sleep(2)
                     if 'command' in bot_info:
-                        stdin, stdout, stderr = ssh.exec_command(f"nohup {bot_info['command']} > /dev/null 2>&1 &")
+                        command = f"nohup {bot_info['command']} > /dev/null 2>&1 &"
                     else:
                         return False, "No start command available for this process"
             
-            # Wait for command to complete
-            exit_status = stdout.channel.recv_exit_status()
-            error_output = stderr.read().decode().strip()
+            # Wait for command to complete on the SSH worker pool
+            exit_status, _, error_output = await run_blocking(run_ssh_command, ssh, command)
+            error_output = error_output.strip()
             
             if exit_status == 0:
                 return True, f"Bot {action} successful"
@@ -342,21 +351,17 @@ def init_bot_manager(dp, bot, active_sessions, user_input):
                 return False, f"Command failed: {error_output}"
                 
         except Exception as e:
-            logger.error(f"Error controlling bot {bot_id}: {e}")
+            logger.error("Error controlling bot %s: %s", bot_id, e)
             return False, str(e)
     
     # --- CALLBACK HANDLERS ---
     
-    @dp.callback_query_handler(lambda c: c.data.startswith("bot_manager_") or get_cached_callback_data(c.data).startswith("bot_manager_"))
-    async def bot_manager_menu(callback: types.CallbackQuery):
+    async def bot_manager_menu(callback: types.CallbackQuery, payload):
         """Show bot manager main menu"""
         try:
-            # Get actual callback data
-            callback_data = get_cached_callback_data(callback.data)
-            server_id = callback_data.split('_')[2]
+            server_id = payload
             
-            from db import get_server_by_id
-            server = await get_server_by_id(server_id)
+            server = await get_server_cached(server_id)
             
             if not server:
                 await callback.message.edit_text("❌ Server not found.")
@@ -400,16 +405,13 @@ def init_bot_manager(dp, bot, active_sessions, user_input):
                 )
                 
         except Exception as e:
-            logger.error(f"Bot manager menu error: {e}")
+            logger.error("Bot manager menu error: %s", e)
             await callback.message.edit_text("❌ Error loading bot manager.")
     
-    @dp.callback_query_handler(lambda c: c.data.startswith("add_bot_menu_") or get_cached_callback_data(c.data).startswith("add_bot_menu_"))
-    async def add_bot_menu(callback: types.CallbackQuery):
+    async def add_bot_menu(callback: types.CallbackQuery, payload):
         """Show add bot menu"""
         try:
-            # Get actual callback data
-            callback_data = get_cached_callback_data(callback.data)
-            server_id = callback_data.split('_')[3]
+            server_id = payload
             
             systemd_callback = cache_callback_data(f"discover_systemd_{server_id}")
             docker_callback = cache_callback_data(f"discover_docker_{server_id}")
@@ -436,18 +438,13 @@ def init_bot_manager(dp, bot, active_sessions, user_input):
             )
             
         except Exception as e:
-            logger.error(f"Add bot menu error: {e}")
+            logger.error("Add bot menu error: %s", e)
             await callback.message.edit_text("❌ Error loading add bot menu.")
     
-    @dp.callback_query_handler(lambda c: c.data.startswith("discover_") or get_cached_callback_data(c.data).startswith("discover_"))
-    async def discover_services_handler(callback: types.CallbackQuery):
+    async def discover_services_handler(callback: types.CallbackQuery, payload):
         """Discover and show services"""
         try:
-            # Get actual callback data
-            callback_data = get_cached_callback_data(callback.data)
-            parts = callback_data.split('_')
-            service_type = parts[1]
-            server_id = parts[2]
+            service_type, _, server_id = payload.partition('_')
             
             await callback.message.edit_text(f"🔄 <b>Discovering {service_type} services...</b>", parse_mode='HTML')
             
@@ -455,14 +452,12 @@ def init_bot_manager(dp, bot, active_sessions, user_input):
             
             if not services:
                 back_callback = cache_callback_data(f"add_bot_menu_{server_id}")
-                kb = InlineKeyboardMarkup()
-                kb.add(InlineKeyboardButton("⬅️ Back", callback_data=back_callback))
                 
                 await callback.message.edit_text(
                     f"❌ <b>No {service_type} services found</b>\n\n"
                     f"No running {service_type} services were discovered on this server.",
                     parse_mode='HTML',
-                    reply_markup=kb
+                    reply_markup=back_keyboard("⬅️ Back", back_callback)
                 )
                 return
             
@@ -490,19 +485,13 @@ def init_bot_manager(dp, bot, active_sessions, user_input):
             )
             
         except Exception as e:
-            logger.error(f"Discover services error: {e}")
+            logger.error("Discover services error: %s", e)
             await callback.message.edit_text("❌ Error discovering services.")
     
-    @dp.callback_query_handler(lambda c: c.data.startswith("select_service_") or get_cached_callback_data(c.data).startswith("select_service_"))
-    async def select_service_handler(callback: types.CallbackQuery):
+    async def select_service_handler(callback: types.CallbackQuery, payload):
         """Handle service selection"""
         try:
-            # Get actual callback data
-            callback_data = get_cached_callback_data(callback.data)
-            parts = callback_data.split('_', 4)
-            server_id = parts[2]
-            service_type = parts[3]
-            service_name = parts[4]
+            server_id, service_type, service_name = payload.split('_', 2)
             
             # Create bot info
             bot_info = {
@@ -525,39 +514,24 @@ def init_bot_manager(dp, bot, active_sessions, user_input):
                 # Return to bot manager after 2 seconds
                 await asyncio.sleep(2)
                 
-                # Create new callback for bot manager
-                new_callback = types.CallbackQuery(
-                    id=callback.id,
-                    from_user=callback.from_user,
-                    message=callback.message,
-                    data=f"bot_manager_{server_id}",
-                    chat_instance=callback.chat_instance
-                )
-                await bot_manager_menu(new_callback)
+                await bot_manager_menu(callback, server_id)
             else:
                 back_callback = cache_callback_data(f"bot_manager_{server_id}")
                 await callback.message.edit_text(
                     "❌ <b>Bot Already Exists</b>\n\n"
                     "This service is already being managed.",
                     parse_mode='HTML',
-                    reply_markup=InlineKeyboardMarkup().add(
-                        InlineKeyboardButton("⬅️ Back", callback_data=back_callback)
-                    )
+                    reply_markup=back_keyboard("⬅️ Back", back_callback)
                 )
             
         except Exception as e:
-            logger.error(f"Select service error: {e}")
+            logger.error("Select service error: %s", e)
             await callback.message.edit_text("❌ Error adding service.")
     
-    @dp.callback_query_handler(lambda c: c.data.startswith("bot_detail_") or get_cached_callback_data(c.data).startswith("bot_detail_"))
-    async def bot_detail_menu(callback: types.CallbackQuery):
+    async def bot_detail_menu(callback: types.CallbackQuery, payload):
         """Show individual bot detail menu"""
         try:
-            # Get actual callback data
-            callback_data = get_cached_callback_data(callback.data)
-            parts = callback_data.split('_')
-            server_id = parts[2]
-            bot_id = '_'.join(parts[3:])
+            server_id, _, bot_id = payload.partition('_')
             
             await callback.message.edit_text("🔄 <b>Loading bot details...</b>", parse_mode='HTML')
             
@@ -567,9 +541,7 @@ def init_bot_manager(dp, bot, active_sessions, user_input):
                 back_callback = cache_callback_data(f"bot_manager_{server_id}")
                 await callback.message.edit_text(
                     "❌ Bot not found or error loading details.",
-                    reply_markup=InlineKeyboardMarkup().add(
-                        InlineKeyboardButton("⬅️ Back to Bots", callback_data=back_callback)
-                    )
+                    reply_markup=back_keyboard("⬅️ Back to Bots", back_callback)
                 )
                 return
             
@@ -588,18 +560,13 @@ def init_bot_manager(dp, bot, active_sessions, user_input):
             )
             
         except Exception as e:
-            logger.error(f"Bot detail error: {e}")
+            logger.error("Bot detail error: %s", e)
             await callback.message.edit_text("❌ Error loading bot details.")
     
-    @dp.callback_query_handler(lambda c: c.data.startswith("bot_start_") or get_cached_callback_data(c.data).startswith("bot_start_"))
-    async def bot_start(callback: types.CallbackQuery):
+    async def bot_start(callback: types.CallbackQuery, payload):
         """Start a bot"""
         try:
-            # Get actual callback data
-            callback_data = get_cached_callback_data(callback.data)
-            parts = callback_data.split('_')
-            server_id = parts[2]
-            bot_id = '_'.join(parts[3:])
+            server_id, _, bot_id = payload.partition('_')
             
             await callback.message.edit_text("🔄 <b>Starting bot...</b>", parse_mode='HTML')
             
@@ -611,32 +578,23 @@ def init_bot_manager(dp, bot, active_sessions, user_input):
                 await callback.message.edit_text(
                     f"✅ <b>Bot Started</b>\n\n{message}",
                     parse_mode='HTML',
-                    reply_markup=InlineKeyboardMarkup().add(
-                        InlineKeyboardButton("⬅️ Back to Bot", callback_data=back_callback)
-                    )
+                    reply_markup=back_keyboard("⬅️ Back to Bot", back_callback)
                 )
             else:
                 await callback.message.edit_text(
                     f"❌ <b>Failed to Start Bot</b>\n\n{message}",
                     parse_mode='HTML',
-                    reply_markup=InlineKeyboardMarkup().add(
-                        InlineKeyboardButton("⬅️ Back to Bot", callback_data=back_callback)
-                    )
+                    reply_markup=back_keyboard("⬅️ Back to Bot", back_callback)
                 )
                 
         except Exception as e:
-            logger.error(f"Bot start error: {e}")
+            logger.error("Bot start error: %s", e)
             await callback.message.edit_text("❌ Error starting bot.")
     
-    @dp.callback_query_handler(lambda c: c.data.startswith("bot_stop_") or get_cached_callback_data(c.data).startswith("bot_stop_"))
-    async def bot_stop(callback: types.CallbackQuery):
+    async def bot_stop(callback: types.CallbackQuery, payload):
         """Stop a bot"""
         try:
-            # Get actual callback data
-            callback_data = get_cached_callback_data(callback.data)
-            parts = callback_data.split('_')
-            server_id = parts[2]
-            bot_id = '_'.join(parts[3:])
+            server_id, _, bot_id = payload.partition('_')
             
             await callback.message.edit_text("🔄 <b>Stopping bot...</b>", parse_mode='HTML')
             
@@ -648,32 +606,23 @@ def init_bot_manager(dp, bot, active_sessions, user_input):
                 await callback.message.edit_text(
                     f"✅ <b>Bot Stopped</b>\n\n{message}",
                     parse_mode='HTML',
-                    reply_markup=InlineKeyboardMarkup().add(
-                        InlineKeyboardButton("⬅️ Back to Bot", callback_data=back_callback)
-                    )
+                    reply_markup=back_keyboard("⬅️ Back to Bot", back_callback)
                 )
             else:
                 await callback.message.edit_text(
                     f"❌ <b>Failed to Stop Bot</b>\n\n{message}",
                     parse_mode='HTML',
-                    reply_markup=InlineKeyboardMarkup().add(
-                        InlineKeyboardButton("⬅️ Back to Bot", callback_data=back_callback)
-                    )
+                    reply_markup=back_keyboard("⬅️ Back to Bot", back_callback)
                 )
                 
         except Exception as e:
-            logger.error(f"Bot stop error: {e}")
+            logger.error("Bot stop error: %s", e)
             await callback.message.edit_text("❌ Error stopping bot.")
     
-    @dp.callback_query_handler(lambda c: c.data.startswith("bot_restart_") or get_cached_callback_data(c.data).startswith("bot_restart_"))
-    async def bot_restart(callback: types.CallbackQuery):
+    async def bot_restart(callback: types.CallbackQuery, payload):
         """Restart a bot"""
         try:
-            # Get actual callback data
-            callback_data = get_cached_callback_data(callback.data)
-            parts = callback_data.split('_')
-            server_id = parts[2]
-            bot_id = '_'.join(parts[3:])
+            server_id, _, bot_id = payload.partition('_')
             
             await callback.message.edit_text("🔄 <b>Restarting bot...</b>", parse_mode='HTML')
             
@@ -685,32 +634,23 @@ def init_bot_manager(dp, bot, active_sessions, user_input):
                 await callback.message.edit_text(
                     f"✅ <b>Bot Restarted</b>\n\n{message}",
                     parse_mode='HTML',
-                    reply_markup=InlineKeyboardMarkup().add(
-                        InlineKeyboardButton("⬅️ Back to Bot", callback_data=back_callback)
-                    )
+                    reply_markup=back_keyboard("⬅️ Back to Bot", back_callback)
                 )
             else:
                 await callback.message.edit_text(
                     f"❌ <b>Failed to Restart Bot</b>\n\n{message}",
                     parse_mode='HTML',
-                    reply_markup=InlineKeyboardMarkup().add(
-                        InlineKeyboardButton("⬅️ Back to Bot", callback_data=back_callback)
-                    )
+                    reply_markup=back_keyboard("⬅️ Back to Bot", back_callback)
                 )
                 
         except Exception as e:
-            logger.error(f"Bot restart error: {e}")
+            logger.error("Bot restart error: %s", e)
             await callback.message.edit_text("❌ Error restarting bot.")
     
-    @dp.callback_query_handler(lambda c: c.data.startswith("bot_logs_") or get_cached_callback_data(c.data).startswith("bot_logs_"))
-    async def bot_logs(callback: types.CallbackQuery):
+    async def bot_logs(callback: types.CallbackQuery, payload):
         """Show bot logs"""
         try:
-            # Get actual callback data
-            callback_data = get_cached_callback_data(callback.data)
-            parts = callback_data.split('_')
-            server_id = parts[2]
-            bot_id = '_'.join(parts[3:])
+            server_id, _, bot_id = payload.partition('_')
             
             await callback.message.edit_text("🔄 <b>Fetching logs...</b>", parse_mode='HTML')
             
@@ -733,18 +673,16 @@ def init_bot_manager(dp, bot, active_sessions, user_input):
             
             bot_type = bot_info['type']
             bot_name = bot_info['name']
+            quoted_name = shlex.quote(bot_name)
             
             logs = ""
             
             if bot_type == 'systemd':
-                stdin, stdout, stderr = ssh.exec_command(f"journalctl -u {bot_name} --no-pager -n 20")
-                logs = stdout.read().decode().strip()
+                logs = await run_command(ssh, f"journalctl -u {quoted_name} --no-pager -n 20")
             elif bot_type == 'docker':
-                stdin, stdout, stderr = ssh.exec_command(f"docker logs --tail 20 {bot_name}")
-                logs = stdout.read().decode().strip()
+                logs = await run_command(ssh, f"docker logs --tail 20 {quoted_name}")
             elif bot_type == 'pm2':
-                stdin, stdout, stderr = ssh.exec_command(f"pm2 logs {bot_name} --lines 20 --nostream")
-                logs = stdout.read().decode().strip()
+                logs = await run_command(ssh, f"pm2 logs {quoted_name} --lines 20 --nostream")
             elif bot_type == 'process':
                 logs = "Process logs not available. Check system logs or application-specific log files."
             
@@ -759,26 +697,19 @@ def init_bot_manager(dp, bot, active_sessions, user_input):
             
             await callback.message.edit_text(
                 f"📊 <b>Bot Logs</b>\n\n"
-                f"<code>{logs}</code>",
+                f"<code>{escape_html(logs)}</code>",
                 parse_mode='HTML',
-                reply_markup=InlineKeyboardMarkup().add(
-                    InlineKeyboardButton("⬅️ Back to Bot", callback_data=back_callback)
-                )
+                reply_markup=back_keyboard("⬅️ Back to Bot", back_callback)
             )
             
         except Exception as e:
-            logger.error(f"Bot logs error: {e}")
+            logger.error("Bot logs error: %s", e)
             await callback.message.edit_text("❌ Error fetching logs.")
     
-    @dp.callback_query_handler(lambda c: c.data.startswith("bot_remove_") or get_cached_callback_data(c.data).startswith("bot_remove_"))
-    async def bot_remove_confirm(callback: types.CallbackQuery):
+    async def bot_remove_confirm(callback: types.CallbackQuery, payload):
         """Confirm bot removal"""
         try:
-            # Get actual callback data
-            callback_data = get_cached_callback_data(callback.data)
-            parts = callback_data.split('_')
-            server_id = parts[2]
-            bot_id = '_'.join(parts[3:])
+            server_id, _, bot_id = payload.partition('_')
             
             # Find bot in managed list
             bots = get_managed_bots(server_id)
@@ -812,18 +743,13 @@ def init_bot_manager(dp, bot, active_sessions, user_input):
             )
             
         except Exception as e:
-            logger.error(f"Bot remove confirm error: {e}")
+            logger.error("Bot remove confirm error: %s", e)
             await callback.message.edit_text("❌ Error confirming removal.")
     
-    @dp.callback_query_handler(lambda c: c.data.startswith("bot_remove_confirm_") or get_cached_callback_data(c.data).startswith("bot_remove_confirm_"))
-    async def bot_remove_execute(callback: types.CallbackQuery):
+    async def bot_remove_execute(callback: types.CallbackQuery, payload):
         """Execute bot removal"""
         try:
-            # Get actual callback data
-            callback_data = get_cached_callback_data(callback.data)
-            parts = callback_data.split('_')
-            server_id = parts[3]
-            bot_id = '_'.join(parts[4:])
+            server_id, _, bot_id = payload.partition('_')
             
             if remove_managed_bot(server_id, bot_id):
                 back_callback = cache_callback_data(f"bot_manager_{server_id}")
@@ -831,26 +757,19 @@ def init_bot_manager(dp, bot, active_sessions, user_input):
                     "✅ <b>Bot Removed</b>\n\n"
                     "Bot has been removed from the manager.",
                     parse_mode='HTML',
-                    reply_markup=InlineKeyboardMarkup().add(
-                        InlineKeyboardButton("⬅️ Back to Bots", callback_data=back_callback)
-                    )
+                    reply_markup=back_keyboard("⬅️ Back to Bots", back_callback)
                 )
             else:
                 await callback.message.edit_text("❌ Failed to remove bot.")
                 
         except Exception as e:
-            logger.error(f"Bot remove execute error: {e}")
+            logger.error("Bot remove execute error: %s", e)
             await callback.message.edit_text("❌ Error removing bot.")
     
-    @dp.callback_query_handler(lambda c: c.data.startswith("bot_settings_") or get_cached_callback_data(c.data).startswith("bot_settings_"))
-    async def bot_settings(callback: types.CallbackQuery):
+    async def bot_settings(callback: types.CallbackQuery, payload):
         """Bot settings placeholder"""
         try:
-            # Get actual callback data
-            callback_data = get_cached_callback_data(callback.data)
-            parts = callback_data.split('_')
-            server_id = parts[2]
-            bot_id = '_'.join(parts[3:])
+            server_id, _, bot_id = payload.partition('_')
             
             back_callback = cache_callback_data(f"bot_detail_{server_id}_{bot_id}")
             
@@ -863,12 +782,39 @@ def init_bot_manager(dp, bot, active_sessions, user_input):
                 "• Configure auto-restart\n"
                 "• Set up monitoring",
                 parse_mode='HTML',
-                reply_markup=InlineKeyboardMarkup().add(
-                    InlineKeyboardButton("⬅️ Back to Bot", callback_data=back_callback)
-                )
+                reply_markup=back_keyboard("⬅️ Back to Bot", back_callback)
             )
         except Exception as e:
-            logger.error(f"Bot settings error: {e}")
+            logger.error("Bot settings error: %s", e)
             await callback.message.edit_text("❌ Error loading settings.")
     
+    # --- DISPATCH ---
+    
+    # Longest prefix first, so bot_remove_confirm_ is not taken for bot_remove_
+    bot_actions = (
+        ("bot_remove_confirm_", bot_remove_execute),
+        ("select_service_", select_service_handler),
+        ("add_bot_menu_", add_bot_menu),
+        ("bot_settings_", bot_settings),
+        ("bot_manager_", bot_manager_menu),
+        ("bot_restart_", bot_restart),
+        ("bot_detail_", bot_detail_menu),
+        ("bot_remove_", bot_remove_confirm),
+        ("bot_start_", bot_start),
+        ("discover_", discover_services_handler),
+        ("bot_stop_", bot_stop),
+        ("bot_logs_", bot_logs),
+    )
+    bot_prefixes = tuple(prefix for prefix, _ in bot_actions)
+    
+    @dp.callback_query_handler(lambda c: get_cached_callback_data(c.data).startswith(bot_prefixes))
+    async def bot_manager_dispatch(callback: types.CallbackQuery):
+        # Resolve hashed callback data once, pick the handler and hand it the payload after the prefix;
+        # server ids are ObjectId hex and never contain '_', so handlers split the payload with partition
+        callback_data = get_cached_callback_data(callback.data)
+        for prefix, handler in bot_actions:
+            if callback_data.startswith(prefix):
+                await handler(callback, callback_data[len(prefix):])
+                return
+    
     logger.info("✅ Bot manager handlers initialized")
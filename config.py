@@ -19,13 +19,29 @@ if MONGO_URI.startswith('mongodb+srv://'):
 else:
     print("✅ Using local MongoDB connection")
 
+# Bot API configuration
+BOT_CONNECTIONS_LIMIT = 100  # Concurrent connections to the Telegram Bot API
+BOT_API_TIMEOUT = 60  # Seconds before a Bot API request is abandoned
+
 # SSH configuration
 SSH_TIMEOUT = 15
 MAX_CONNECTIONS = 10
+SSH_KEEPALIVE_INTERVAL = 30  # Seconds between keepalive packets on idle sessions
+SSH_REAP_INTERVAL = 60  # Seconds between sweeps for dead sessions
+SSH_MAX_OUTPUT = 1024 * 1024  # Bytes of command output kept per stream
+SSH_WORKERS = 32  # Threads available for blocking SSH/SFTP calls
+SSH_MAX_CHANNELS = 8  # Concurrent channels per connection, below sshd's MaxSessions
 
 # File manager configuration
 MAX_FILE_SIZE = 50 * 1024 * 1024  # 50 MB
 ALLOWED_EXTENSIONS= None
+LISTING_CACHE_TTL = 10  # Seconds a directory listing is reused before re-running find
+SERVER_CACHE_TTL = 60  # Seconds a server record is reused before querying the database again
+SERVER_CACHE_SIZE = 512  # Server records kept in the cache at most
+DUPLICATE_TAP_WINDOW = 0.5  # Seconds within which a repeated tap on the same button is ignored
+USER_STATE_TTL = 30 * 60  # Seconds of inactivity before a user's file manager state and prompts are dropped
+USER_STATE_PRUNE_INTERVAL = 5 * 60  # Seconds between sweeps for idle users
+ARCHIVE_JOBS_PER_SERVER = 2  # Archive extractions allowed to run at once on one server
 
 # Logging configuration
 LOG_LEVEL = 'INFO'
@@ -16,20 +16,20 @@ async def add_server(data):
     """Add a new server to the database"""
     try:
         result = await servers_collection.insert_one(data)
-        logger.info(f"Added server with ID: {result.inserted_id}")
+        logger.info("Added server with ID: %s", result.inserted_id)
         return result.inserted_id
     except Exception as e:
-        logger.error(f"Error adding server: {e}")
+        logger.error("Error adding server: %s", e)
         raise
 
 async def get_servers():
     """Get all servers from the database"""
     try:
         servers = await servers_collection.find().to_list(None)
-        logger.info(f"Retrieved {len(servers)} servers")
+        logger.info("Retrieved %s servers", len(servers))
         return servers
     except Exception as e:
-        logger.error(f"Error fetching servers: {e}")
+        logger.error("Error fetching servers: %s", e)
         return []
 
 async def get_server_by_id(server_id):
@@ -37,12 +37,12 @@ async def get_server_by_id(server_id):
     try:
         server = await servers_collection.find_one({"_id": ObjectId(server_id)})
         if server:
-            logger.info(f"Retrieved server: {server.get('name', 'Unknown')}")
+            logger.info("Retrieved server: %s", server.get('name', 'Unknown'))
         else:
-            logger.warning(f"Server not found: {server_id}")
+            logger.warning("Server not found: %s", server_id)
         return server
     except Exception as e:
-        logger.error(f"Error fetching server {server_id}: {e}")
+        logger.error("Error fetching server %s: %s", server_id, e)
         return None
 
 async def update_server_name(server_id, new_name):
@@ -53,12 +53,12 @@ async def update_server_name(server_id, new_name):
             {"$set": {"name": new_name}}
         )
         if result.modified_count > 0:
-            logger.info(f"Updated server name to: {new_name}")
+            logger.info("Updated server name to: %s", new_name)
         else:
-            logger.warning(f"No server updated for ID: {server_id}")
+            logger.warning("No server updated for ID: %s", server_id)
         return result.modified_count > 0
     except Exception as e:
-        logger.error(f"Error updating name for server {server_id}: {e}")
+        logger.error("Error updating name for server %s: %s", server_id, e)
         raise
 
 async def update_server_username(server_id, new_username):
@@ -69,12 +69,12 @@ async def update_server_username(server_id, new_username):
             {"$set": {"username": new_username}}
         )
         if result.modified_count > 0:
-            logger.info(f"Updated server username to: {new_username}")
+            logger.info("Updated server username to: %s", new_username)
         else:
-            logger.warning(f"No server updated for ID: {server_id}")
+            logger.warning("No server updated for ID: %s", server_id)
         return result.modified_count > 0
     except Exception as e:
-        logger.error(f"Error updating username for server {server_id}: {e}")
+        logger.error("Error updating username for server %s: %s", server_id, e)
         raise
 
 async def delete_server_by_id(server_id):
@@ -82,12 +82,12 @@ async def delete_server_by_id(server_id):
     try:
         result = await servers_collection.delete_one({"_id": ObjectId(server_id)})
         if result.deleted_count > 0:
-            logger.info(f"Deleted server with ID: {server_id}")
+            logger.info("Deleted server with ID: %s", server_id)
         else:
-            logger.warning(f"No server deleted for ID: {server_id}")
+            logger.warning("No server deleted for ID: %s", server_id)
         return result.deleted_count > 0
     except Exception as e:
-        logger.error(f"Error deleting server {server_id}: {e}")
+        logger.error("Error deleting server %s: %s", server_id, e)
         raise
 
 async def update_server_stats(server_id, stats):
@@ -99,7 +99,7 @@ async def update_server_stats(server_id, stats):
         )
         return result.modified_count > 0
     except Exception as e:
-        logger.error(f"Error updating stats for server {server_id}: {e}")
+        logger.error("Error updating stats for server %s: %s", server_id, e)
         return False
 
 # Health check function
@@ -110,5 +110,5 @@ async def check_database_connection():
         logger.info("Database connection successful")
         return True
     except Exception as e:
-        logger.error(f"Database connection failed: {e}")
+        logger.error("Database connection failed: %s", e)
         return False
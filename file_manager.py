@@ -1,838 +1,1052 @@
 import logging
-import os
-import zipfile
-import tarfile
+import asyncio
+import posixpath
 import tempfile
 import shutil
 import hashlib
+import stat
+import shlex
+import time
+from dataclasses import dataclass, field
+from functools import lru_cache, wraps
+from typing import Optional
 from datetime import datetime
 from aiogram import types
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
-import paramiko
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.utils.exceptions import MessageNotModified, MessageCantBeEdited, MessageToEditNotFound
+from ssh_manager import get_live_session, get_ssh_session, execute_ssh_command, run_blocking, sftp_session, list_directory
+from db import get_server_by_id
+from config import LISTING_CACHE_TTL, SERVER_CACHE_TTL, SERVER_CACHE_SIZE, MAX_FILE_SIZE, SSH_REAP_INTERVAL, DUPLICATE_TAP_WINDOW, USER_STATE_TTL, USER_STATE_PRUNE_INTERVAL, ARCHIVE_JOBS_PER_SERVER
 
 logger = logging.getLogger(__name__)
 
 # Global variables for file manager state
-file_manager_state = {}
-selected_files = {}
+file_manager_state = {}  # Per-user file manager state: {user_id: FileManagerState}
 file_name_cache = {}  # Cache for long filenames: {hash: filename}
+listing_cache = {}  # Cache for directory listings: {(server_id, path): (timestamp, files)}
+listing_locks = {}  # Listings in flight: {(server_id, path): asyncio.Lock}
+server_cache = {}  # Cache for server records: {server_id: (timestamp, server)}
+server_cache_locks = {}  # Lookups in flight: {server_id: asyncio.Lock}
+session_locks = {}  # Reconnects in flight: {server_id: asyncio.Lock}
+archive_slots = {}  # Concurrent archive jobs per server: {server_id: asyncio.Semaphore}
+background_tasks = set()  # Background jobs started with spawn() that are still running
+last_callback = {}  # Most recent fm_ callback per user: {user_id: (data, timestamp)}
+user_queues = {}  # Pending fm_ handlers per user: {user_id: asyncio.Queue}
+user_activity = {}  # Last update from each user, oldest first: {user_id: timestamp}
 
-def get_file_hash(filename):
-    """Generate short hash for long filenames"""
-    return hashlib.md5(filename.encode()).hexdigest()[:8]
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+# Telegram allows 64 bytes of callback data; the longest, fm_confirm_delete_single_<server id>_, takes 50
+FILENAME_INLINE_BYTES = 14
+SERVER_ID_LENGTH = 24  # Hex MongoDB ObjectId
+FILE_NAME_CACHE_SIZE = 10000
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz', '.rar', '.7z')
+
+@dataclass(slots=True)
+class FileManagerState:
+    """File manager state for one user"""
+    server_id: str
+    current_path: str
+    home_path: str  # Navigation floor, the SSH user's home directory
+    selection_mode: bool = False
+    selected_files: set[str] = field(default_factory=set)
+    operation: Optional[str] = None  # 'copy' or 'move' while choosing a destination
+    operation_files: tuple[str, ...] = ()  # Snapshot of the selection taken when the operation started
+    operation_source: Optional[str] = None
+    rendered: Optional[tuple] = None  # (listing cache entry, view key) of the last file manager render
+
+@dataclass(slots=True)
+class UserInput:
+    """Text or file the bot is waiting for from one user"""
+    step: Optional[str] = None  # Add-server wizard: 'name', 'username', 'ip' or 'key'
+    edit: Optional[str] = None  # Server field being changed: 'name' or 'username'
+    action: Optional[str] = None  # File manager prompt: 'new_folder', 'rename' or 'upload'
+    server_id: Optional[str] = None
+    path: Optional[str] = None
+    old_name: Optional[str] = None
+    name: Optional[str] = None
+    username: Optional[str] = None
+    ip: Optional[str] = None
+
+@dataclass(slots=True)
+class FileEntry:
+    """One directory entry with its button label and callback token"""
+    name: str
+    is_dir: bool
+    label: str
+    token: str
+    # Unselected keyboard rows, built on first render of this listing in each mode
+    row: Optional[list] = None
+    select_row: Optional[list] = None
+
+# Characters that cannot appear in a single file name, plus line breaks
+FILENAME_FORBIDDEN = str.maketrans('', '', '/\0\n\r')
+
+# Characters Telegram's HTML parse mode needs escaped in message text
+HTML_ESCAPE = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;'})
+
+def get_file_hash(filename, salt=0):
+    """Generate short hash for long filenames, salt picks an alternative on collision"""
+    data = filename.encode() if not salt else f"{salt}:{filename}".encode()
+    # A token is '/' plus the hash and has to fit in the FILENAME_INLINE_BYTES budget
+    return hashlib.md5(data).hexdigest()[:FILENAME_INLINE_BYTES - 1]
+
+class ButtonExpired(Exception):
+    """A button's hashed file name is no longer in file_name_cache"""
 
 def cache_filename(filename):
-    """Cache filename and return hash if too long"""
-    if len(filename) <= 30:  # Safe length for callback data
+    """Cache filename and return a '/'-prefixed hash token if too long"""
+    if len(filename.encode()) <= FILENAME_INLINE_BYTES:
         return filename
     
+    # A hash already taken by another name is a collision, never overwrite it; salt until free or ours
+    salt = 0
     file_hash = get_file_hash(filename)
+    while file_name_cache.get(file_hash, filename) != filename:
+        salt += 1
+        file_hash = get_file_hash(filename, salt)
+    
+    # Re-insert so dict order tracks the most recently issued tokens, then evict the oldest
+    file_name_cache.pop(file_hash, None)
     file_name_cache[file_hash] = filename
-    return file_hash
+    if len(file_name_cache) > FILE_NAME_CACHE_SIZE:
+        file_name_cache.pop(next(iter(file_name_cache)))
+    # No file name contains '/', so a token can never be mistaken for a real short name
+    return '/' + file_hash
 
 def get_cached_filename(identifier):
-    """Get filename from cache or return identifier if not cached"""
-    return file_name_cache.get(identifier, identifier)
+    """Get filename from a button token, raising ButtonExpired if its hash was evicted"""
+    if not identifier.startswith('/'):
+        return identifier
+    filename = file_name_cache.get(identifier[1:])
+    if filename is None:
+        raise ButtonExpired(identifier)
+    return filename
+
+def prune_listing(server_id, path, names):
+    """Remove deleted entries from a cached listing instead of dropping it"""
+    cached = listing_cache.get((server_id, path))
+    if cached:
+        removed = set(names)
+        listing_cache[(server_id, path)] = (cached[0], [f for f in cached[1] if f.name not in removed])
+
+def sanitize_filename(name):
+    """Strip characters that are not allowed in a single file name"""
+    name = name.translate(FILENAME_FORBIDDEN).strip()
+    return '' if name in ('.', '..') else name
+
+def escape_html(text):
+    """Escape text for HTML messages in a single translate pass"""
+    return str(text).translate(HTML_ESCAPE)
+
+def invalidate_listing(server_id, *paths):
+    """Drop cached listings for directories that were just modified"""
+    for path in paths:
+        listing_cache.pop((server_id, path), None)
+
+async def get_server_cached(server_id):
+    """Get server record, reusing a recent lookup instead of querying the database"""
+    cached = server_cache.get(server_id)
+    if cached and time.monotonic() - cached[0] < SERVER_CACHE_TTL:
+        return cached[1]
+    
+    # Concurrent misses for the same server wait for a single database query
+    lock = server_cache_locks.setdefault(server_id, asyncio.Lock())
+    async with lock:
+        cached = server_cache.get(server_id)
+        if cached and time.monotonic() - cached[0] < SERVER_CACHE_TTL:
+            return cached[1]
+        
+        server = await get_server_by_id(server_id)
+        if server:
+            # Re-insert so dict order tracks freshness, then evict the stalest entry
+            server_cache.pop(server_id, None)
+            server_cache[server_id] = (time.monotonic(), server)
+            if len(server_cache) > SERVER_CACHE_SIZE:
+                server_cache.pop(next(iter(server_cache)))
+        return server
+
+async def prune_server_cache():
+    """Periodically drop expired server records and listings, and idle lookup locks"""
+    while True:
+        await asyncio.sleep(SERVER_CACHE_TTL)
+        now = time.monotonic()
+        for server_id, (timestamp, _) in list(server_cache.items()):
+            if now - timestamp >= SERVER_CACHE_TTL:
+                server_cache.pop(server_id, None)
+        for server_id, lock in list(server_cache_locks.items()):
+            if not lock.locked():
+                server_cache_locks.pop(server_id, None)
+        
+        # Listings a view may still redraw from (reuse=True) are kept for a full server TTL
+        for key, (timestamp, _) in list(listing_cache.items()):
+            if now - timestamp >= SERVER_CACHE_TTL:
+                listing_cache.pop(key, None)
+        for key, lock in list(listing_locks.items()):
+            if not lock.locked():
+                listing_locks.pop(key, None)
+
+def invalidate_server(server_id):
+    """Drop the cached server record after it was edited or deleted"""
+    server_cache.pop(server_id, None)
+
+# --- CACHED KEYBOARD PARTS ---
+# Cached buttons go through kb.row(), which copies them into fresh rows; cached markups are never modified after being built
+
+@lru_cache(maxsize=256)
+def header_buttons(server_id):
+    """Top bar of the file manager view"""
+    return (
+        InlineKeyboardButton("⬅️ Back to Server", callback_data=f"server_{server_id}"),
+        InlineKeyboardButton("📤 Upload", callback_data=f"fm_upload_{server_id}"),
+        InlineKeyboardButton("📁 New Folder", callback_data=f"fm_newfolder_{server_id}")
+    )
+
+@lru_cache(maxsize=256)
+def mode_buttons(server_id, operation, selection_mode):
+    """Row under the top bar: copy/move controls, or the selection mode toggle"""
+    if operation in ('copy', 'move'):
+        return (
+            InlineKeyboardButton(f"📋 {operation.title()} Here", callback_data=f"fm_exec_{operation}_{server_id}"),
+            InlineKeyboardButton("❌ Cancel", callback_data=f"fm_cancel_op_{server_id}")
+        )
+    if selection_mode:
+        return (InlineKeyboardButton("❌ Cancel Selection", callback_data=f"fm_cancel_select_{server_id}"),)
+    return (InlineKeyboardButton("☑️ Select", callback_data=f"fm_select_mode_{server_id}"),)
+
+@lru_cache(maxsize=256)
+def selection_footer_buttons(server_id):
+    """Actions and cancel buttons shown while items are selected"""
+    return (
+        InlineKeyboardButton("🔧 Actions", callback_data=f"fm_actions_{server_id}"),
+        InlineKeyboardButton("❌ Cancel", callback_data=f"fm_cancel_select_{server_id}")
+    )
+
+@lru_cache(maxsize=256)
+def parent_button(server_id):
+    """Parent directory button at the bottom of the file manager view"""
+    return InlineKeyboardButton("📁 .. (Parent Directory)", callback_data=f"fm_parent_{server_id}")
+
+@lru_cache(maxsize=256)
+def selection_actions_keyboard(server_id):
+    """Actions menu for selected items"""
+    kb = InlineKeyboardMarkup(row_width=2)
+    kb.add(
+        InlineKeyboardButton("🗜️ Zip", callback_data=f"fm_action_zip_{server_id}"),
+        InlineKeyboardButton("🗑️ Delete", callback_data=f"fm_action_delete_{server_id}")
+    )
+    kb.add(
+        InlineKeyboardButton("📋 Copy", callback_data=f"fm_action_copy_{server_id}"),
+        InlineKeyboardButton("📁 Move", callback_data=f"fm_action_move_{server_id}")
+    )
+    kb.add(InlineKeyboardButton("⬅️ Back", callback_data=f"fm_cancel_select_{server_id}"))
+    return kb
+
+@lru_cache(maxsize=256)
+def file_menu_keyboard(server_id, file_name, cached_name):
+    """Actions menu for a single file, cached_name is the callback-safe form of file_name"""
+    kb = InlineKeyboardMarkup(row_width=2)
+    
+    # Archives get Extract, everything else gets Zip
+    if file_name.lower().endswith(ARCHIVE_EXTENSIONS):
+        kb.add(
+            InlineKeyboardButton("📤 Download", callback_data=f"fm_download_{server_id}_{cached_name}"),
+            InlineKeyboardButton("📦 Extract", callback_data=f"fm_extract_{server_id}_{cached_name}")
+        )
+    else:
+        kb.add(
+            InlineKeyboardButton("📤 Download", callback_data=f"fm_download_{server_id}_{cached_name}"),
+            InlineKeyboardButton("🗜️ Zip", callback_data=f"fm_zip_single_{server_id}_{cached_name}")
+        )
+    
+    kb.add(
+        InlineKeyboardButton("✏️ Rename", callback_data=f"fm_rename_{server_id}_{cached_name}"),
+        InlineKeyboardButton("🗑️ Delete", callback_data=f"fm_delete_single_{server_id}_{cached_name}")
+    )
+    kb.add(
+        InlineKeyboardButton("📋 Copy", callback_data=f"fm_copy_single_{server_id}_{cached_name}"),
+        InlineKeyboardButton("📁 Move", callback_data=f"fm_move_single_{server_id}_{cached_name}")
+    )
+    kb.add(InlineKeyboardButton("⬅️ Back", callback_data=f"file_manager_{server_id}"))
+    return kb
+
+@lru_cache(maxsize=256)
+def bulk_delete_keyboard(server_id):
+    """Confirmation keyboard for deleting the selected items"""
+    return InlineKeyboardMarkup(row_width=2).add(
+        InlineKeyboardButton("✅ Yes, Delete", callback_data=f"fm_confirm_delete_{server_id}"),
+        InlineKeyboardButton("❌ Cancel", callback_data=f"fm_actions_{server_id}")
+    )
+
+@lru_cache(maxsize=256)
+def back_to_file_manager(server_id):
+    """Keyboard with a single button back to the file manager"""
+    return InlineKeyboardMarkup().add(InlineKeyboardButton("📂 Back to File Manager", callback_data=f"file_manager_{server_id}"))
+
+def is_message_unchanged(message, text, kb):
+    """Check if editing the message would leave its text and keyboard as they are"""
+    if message.reply_markup is None:
+        return False
+    try:
+        same_text = message.html_text == text
+    except TypeError:
+        return False
+    return same_text and message.reply_markup.to_python() == kb.to_python()
+
+def archive_slot(server_id):
+    """Semaphore bounding concurrent archive extractions on one server"""
+    slot = archive_slots.get(server_id)
+    if slot is None:
+        slot = archive_slots[server_id] = asyncio.Semaphore(ARCHIVE_JOBS_PER_SERVER)
+    return slot
+
+def spawn(coro):
+    """Run a coroutine in the background, keeping a reference until it finishes"""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+def enqueue_callback(user_id, job):
+    """Queue a handler behind the user's earlier taps without holding up other users"""
+    queue = user_queues.get(user_id)
+    if queue is None:
+        queue = user_queues[user_id] = asyncio.Queue()
+        spawn(drain_user_queue(user_id, queue))
+    queue.put_nowait(job)
+
+async def drain_user_queue(user_id, queue):
+    """Run one user's queued handlers in order, exiting once the queue is empty"""
+    while not queue.empty():
+        job = queue.get_nowait()
+        try:
+            await job
+        except Exception as e:
+            # Keep draining so one failed handler doesn't drop the taps behind it
+            logger.error("File manager handler failed for user %s: %s", user_id, e)
+    user_queues.pop(user_id, None)
+
+async def fail(callback, log_message, error, user_message):
+    """Log a handler failure and show it in place of the current view"""
+    logger.error(log_message, error)
+    try:
+        await callback.message.edit_text(user_message)
+    except (MessageCantBeEdited, MessageToEditNotFound):
+        # The view is gone or not a bot text message; report in a new one instead
+        await callback.message.answer(user_message)
+
+def catch_errors(log_message, user_message=None):
+    """Log exceptions from a callback handler, replacing the view with user_message if given"""
+    def decorator(handler):
+        @wraps(handler)
+        async def wrapper(callback, *args, **kwargs):
+            try:
+                return await handler(callback, *args, **kwargs)
+            except ButtonExpired:
+                await callback.answer("⚠️ This button has expired. Please reopen the folder.", show_alert=True)
+            except Exception as e:
+                if user_message is None:
+                    logger.error(log_message, e)
+                else:
+                    await fail(callback, log_message, e, user_message)
+        return wrapper
+    return decorator
+
+def callback_server_id(data):
+    """Server id field of an fm_ callback, the first field after the action words (all of them shorter)"""
+    for part in data.split('_', 5)[1:]:
+        if len(part) == SERVER_ID_LENGTH:
+            return part
+    return None
+
+def with_state(handler):
+    """Pass the user's file manager state to a callback handler, rejecting stale buttons"""
+    @wraps(handler)
+    async def wrapper(callback):
+        state = file_manager_state.get(callback.from_user.id)
+        # Buttons from before a restart, or from a file manager since reopened on another server;
+        # past this check the handler can take the server id from the state
+        if state is None or callback_server_id(callback.data) != state.server_id:
+            logger.debug("Invalid file manager state for user %s", callback.from_user.id)
+            await callback.answer("⚠️ Session expired. Please reopen the File Manager.", show_alert=True)
+            return
+        return await handler(callback, state)
+    return wrapper
+
+async def keep_sessions_warm():
+    """Reconnect servers with open file managers before the next tap needs them"""
+    while True:
+        await asyncio.sleep(SSH_REAP_INTERVAL)
+        for server_id in {state.server_id for state in file_manager_state.values()}:
+            # Through the per-server lock, so a tap reconnecting at the same time shares one client
+            await acquire_session(server_id)
+
+# --- IDLE USER CLEANUP ---
+
+class UserActivityMiddleware(BaseMiddleware):
+    """Record when each user last sent a message or tapped a button"""
+    async def on_pre_process_message(self, message, data):
+        touch_user(message.from_user.id)
+    
+    async def on_pre_process_callback_query(self, callback, data):
+        touch_user(callback.from_user.id)
+
+def touch_user(user_id):
+    """Mark a user as active, moving them to the end of user_activity"""
+    user_activity.pop(user_id, None)
+    user_activity[user_id] = time.monotonic()
+
+async def prune_idle_users(user_input):
+    """Periodically drop per-user state of users idle for longer than USER_STATE_TTL"""
+    while True:
+        await asyncio.sleep(USER_STATE_PRUNE_INTERVAL)
+        cutoff = time.monotonic() - USER_STATE_TTL
+        pruned = 0
+        # Oldest entries come first, so stop at the first user still active
+        for user_id, last_seen in list(user_activity.items()):
+            if last_seen >= cutoff:
+                break
+            if user_id in user_queues:
+                continue
+            user_activity.pop(user_id, None)
+            file_manager_state.pop(user_id, None)
+            last_callback.pop(user_id, None)
+            user_input.pop(user_id, None)
+            pruned += 1
+        if pruned:
+            logger.info("Pruned state of %d idle users", pruned)
 
 def init_file_manager(dp, bot, active_sessions, user_input):
     """Initialize file manager handlers"""
+    dp.middleware.setup(UserActivityMiddleware())
     
     # --- FILE MANAGER MAIN ---
     @dp.callback_query_handler(lambda c: c.data.startswith("file_manager_"))
+    @catch_errors("File manager main error: %s", "❌ Error accessing file manager.")
     async def file_manager_main(callback: types.CallbackQuery):
-        try:
-            server_id = callback.data.split('_')[2]
-            user_id = callback.from_user.id
-            
-            # Initialize user state
-            if user_id not in file_manager_state:
-                file_manager_state[user_id] = {}
-            
-            file_manager_state[user_id]['server_id'] = server_id
-            file_manager_state[user_id]['current_path'] = f"/home/{await get_current_user(server_id, active_sessions)}"
-            file_manager_state[user_id]['selection_mode'] = False
-            file_manager_state[user_id]['operation'] = None
-            
-            # Clear selections
-            if user_id in selected_files:
-                selected_files[user_id] = []
-            
-            await show_file_manager(callback, server_id, file_manager_state[user_id]['current_path'])
-            
-        except Exception as e:
-            logger.error(f"File manager main error: {e}")
-            await callback.message.edit_text("❌ Error accessing file manager.")
+        server_id = callback.data.split('_')[2]
+        user_id = callback.from_user.id
+        
+        server = await get_server_cached(server_id)
+        if not server:
+            await callback.message.edit_text("❌ Server not found.")
+            return
+        
+        # Reuses the stored session, reconnecting under the server's lock only when it is gone
+        if await acquire_session(server_id) is None:
+            await callback.message.edit_text("❌ Could not connect to the server.")
+            return
+        
+        # Start from a fresh state with no selection or pending operation
+        home_path = f"/home/{server['username']}"
+        state = FileManagerState(server_id=server_id, current_path=home_path, home_path=home_path)
+        file_manager_state[user_id] = state
+        
+        await show_file_manager(callback, server_id, state.current_path)
 
     # --- SHOW FILE MANAGER ---
-    async def show_file_manager(callback, server_id, path):
-        try:
-            user_id = callback.from_user.id
-            
-            # Get file listing
-            files = await get_file_listing(server_id, path, active_sessions)
-            
-            if files is None:
-                await callback.message.edit_text("❌ Error accessing directory.")
-                return
-            
-            # Create header buttons
-            kb = InlineKeyboardMarkup(row_width=3)
-            kb.add(
-                InlineKeyboardButton("⬅️ Back to Server", callback_data=f"server_{server_id}"),
-                InlineKeyboardButton("📤 Upload", callback_data=f"fm_upload_{server_id}"),
-                InlineKeyboardButton("📁 New Folder", callback_data=f"fm_newfolder_{server_id}")
-            )
-            
-            # Add select/deselect all button
-            selection_mode = file_manager_state.get(user_id, {}).get('selection_mode', False)
-            operation = file_manager_state.get(user_id, {}).get('operation')
-            
-            if operation in ['copy', 'move']:
-                # Show operation buttons
-                kb.add(
-                    InlineKeyboardButton(f"📋 {operation.title()} Here", callback_data=f"fm_exec_{operation}_{server_id}"),
-                    InlineKeyboardButton("❌ Cancel", callback_data=f"fm_cancel_op_{server_id}")
-                )
-            elif selection_mode:
-                kb.add(InlineKeyboardButton("❌ Cancel Selection", callback_data=f"fm_cancel_select_{server_id}"))
-            else:
-                kb.add(InlineKeyboardButton("☑️ Select", callback_data=f"fm_select_mode_{server_id}"))
-            
-            # Add files and folders
-            for file_info in files:
-                if file_info['name'] == '..':
-                    continue  # Skip parent directory here, add at bottom
-                
-                icon = "📁" if file_info['type'] == 'directory' else "📄"
-                name = file_info['name']
-                
-                # Show selection indicator
-                if selection_mode and user_id in selected_files and name in selected_files[user_id]:
-                    icon = "✅"
-                
-                # Truncate long names for display
-                display_name = name[:25] + "..." if len(name) > 25 else name
-                
-                # Cache filename if too long for callback data
-                cached_name = cache_filename(name)
-                
-                if selection_mode:
-                    kb.add(InlineKeyboardButton(f"{icon} {display_name}", 
-                                              callback_data=f"fm_toggle_{server_id}_{cached_name}"))
-                else:
-                    if file_info['type'] == 'directory':
-                        kb.add(InlineKeyboardButton(f"{icon} {display_name}", 
-                                                  callback_data=f"fm_enter_{server_id}_{cached_name}"))
-                    else:
-                        kb.add(InlineKeyboardButton(f"{icon} {display_name}", 
-                                                  callback_data=f"fm_file_{server_id}_{cached_name}"))
-            
-            # Show selected count and actions if in selection mode
-            if selection_mode and user_id in selected_files and selected_files[user_id]:
-                selected_count = len(selected_files[user_id])
-                kb.add(InlineKeyboardButton(f"📋 Selected ({selected_count})", callback_data="fm_noop"))
-                kb.add(
-                    InlineKeyboardButton("🔧 Actions", callback_data=f"fm_actions_{server_id}"),
-                    InlineKeyboardButton("❌ Cancel", callback_data=f"fm_cancel_select_{server_id}")
-                )
-            
-            # Add parent directory button at bottom
-            kb.add(InlineKeyboardButton("📁 .. (Parent Directory)", callback_data=f"fm_parent_{server_id}"))
-            
-            # Path display
-            path_display = path.replace('/home/', '~/')
-            if len(path_display) > 40:
-                path_display = "..." + path_display[-37:]
-            
-            text = f"📂 <b>File Manager</b>\n📍 Path: <code>{path_display}</code>"
-            
-            if operation in ['copy', 'move']:
-                text += f"\n\n🔄 <b>{operation.title()} Operation Active</b>\nNavigate to destination and click '{operation.title()} Here'"
+    @catch_errors("Show file manager error: %s", "❌ Error displaying file manager.")
+    async def show_file_manager(callback, server_id, path, reuse_listing=False):
+        user_id = callback.from_user.id
+        
+        # Get file listing (selection and copy/move redraws reuse any cached one, nothing changed on disk)
+        files = await get_file_listing(server_id, path, active_sessions, reuse=reuse_listing)
+        
+        if files is None:
+            await callback.message.edit_text("❌ Error accessing directory.")
+            return
+        
+        state = file_manager_state.get(user_id)
+        selection_mode = state.selection_mode if state else False
+        operation = state.operation if state else None
+        
+        # Path display
+        path_display = path.replace('/home/', '~/')
+        if len(path_display) > 40:
+            path_display = "..." + path_display[-37:]
+        
+        text = f"📂 <b>File Manager</b>\n📍 Path: <code>{escape_html(path_display)}</code>"
+        
+        if operation in ['copy', 'move']:
+            text += f"\n\n🔄 <b>{operation.title()} Operation Active</b>\nNavigate to destination and click '{operation.title()} Here'"
+        
+        # The view is fully determined by the listing and the selection; when neither changed
+        # since the last render and the message still shows it, skip building the keyboard
+        listing = listing_cache.get((server_id, path))
+        view = (callback.message.message_id, path, selection_mode, operation, frozenset(state.selected_files) if state else None)
+        if state and state.rendered is not None and state.rendered[0] is listing and state.rendered[1] == view:
+            try:
+                if callback.message.html_text == text:
+                    await callback.answer("No change")
+                    return
+            except TypeError:
+                pass
+        
+        # Create header buttons
+        kb = InlineKeyboardMarkup(row_width=3)
+        kb.row(*header_buttons(server_id))
+        
+        # Copy/move controls or the select toggle
+        kb.row(*mode_buttons(server_id, operation, selection_mode))
+        
+        # Add files and folders (listing arrives sorted, build rows in one pass)
+        selected = state.selected_files if selection_mode else ()
+        if selection_mode:
+            dir_prefix = file_prefix = f"fm_toggle_{server_id}_"
+        else:
+            dir_prefix = f"fm_enter_{server_id}_"
+            file_prefix = f"fm_file_{server_id}_"
+        
+        # Unselected rows are built once per listing and mode and kept on the cached entries,
+        # so a toggle only builds buttons for the selected items
+        row_attr = 'select_row' if selection_mode else 'row'
+        rows = []
+        for file_info in files:
+            if file_info.name in selected:
+                rows.append([InlineKeyboardButton(f"✅ {file_info.label}", callback_data=dir_prefix + file_info.token)])
+                continue
             
+            row = getattr(file_info, row_attr)
+            if row is None:
+                icon = "📁" if file_info.is_dir else "📄"
+                prefix = dir_prefix if file_info.is_dir else file_prefix
+                row = [InlineKeyboardButton(f"{icon} {file_info.label}", callback_data=prefix + file_info.token)]
+                setattr(file_info, row_attr, row)
+            rows.append(row)
+        
+        kb.inline_keyboard.extend(rows)
+        
+        # Show selected count and actions if in selection mode
+        if selection_mode and selected:
+            selected_count = len(selected)
+            kb.add(InlineKeyboardButton(f"📋 Selected ({selected_count})", callback_data="fm_noop"))
+            kb.row(*selection_footer_buttons(server_id))
+        
+        # Add parent directory button at bottom
+        kb.row(parent_button(server_id))
+        
+        # Skip the Telegram round-trip when a repeated tap would render the same view
+        if is_message_unchanged(callback.message, text, kb):
+            await callback.answer("No change")
+            return
+        
+        try:
             await callback.message.edit_text(text, parse_mode='HTML', reply_markup=kb)
-            
-        except Exception as e:
-            logger.error(f"Show file manager error: {e}")
-            await callback.message.edit_text("❌ Error displaying file manager.")
+        except MessageNotModified:
+            pass
+        
+        if state:
+            state.rendered = (listing, view)
 
     # --- ENTER DIRECTORY ---
-    @dp.callback_query_handler(lambda c: c.data.startswith("fm_enter_"))
-    async def enter_directory(callback: types.CallbackQuery):
-        try:
-            parts = callback.data.split('_', 3)
-            server_id = parts[2]
-            folder_identifier = parts[3]
-            user_id = callback.from_user.id
-            
-            # Get actual folder name
-            folder_name = get_cached_filename(folder_identifier)
-            
-            current_path = file_manager_state[user_id]['current_path']
-            new_path = os.path.join(current_path, folder_name).replace('\\', '/')
-            file_manager_state[user_id]['current_path'] = new_path
-            
-            await show_file_manager(callback, server_id, new_path)
-            
-        except Exception as e:
-            logger.error(f"Enter directory error: {e}")
-            await callback.message.edit_text("❌ Error entering directory.")
+    @with_state
+    @catch_errors("Enter directory error: %s", "❌ Error entering directory.")
+    async def enter_directory(callback: types.CallbackQuery, state):
+        parts = callback.data.split('_', 3)
+        server_id = state.server_id
+        folder_identifier = parts[3]
+        
+        # Get actual folder name
+        folder_name = get_cached_filename(folder_identifier)
+        
+        current_path = state.current_path
+        new_path = posixpath.join(current_path, folder_name)
+        state.current_path = new_path
+        
+        await show_file_manager(callback, server_id, new_path)
 
     # --- PARENT DIRECTORY ---
-    @dp.callback_query_handler(lambda c: c.data.startswith("fm_parent_"))
-    async def parent_directory(callback: types.CallbackQuery):
-        try:
-            server_id = callback.data.split('_')[2]
-            user_id = callback.from_user.id
-            
-            current_path = file_manager_state[user_id]['current_path']
-            parent_path = os.path.dirname(current_path)
-            
-            # Prevent going above home directory
-            home_path = f"/home/{await get_current_user(server_id, active_sessions)}"
-            if len(parent_path) < len(home_path):
-                parent_path = home_path
-                
-            file_manager_state[user_id]['current_path'] = parent_path
-            
-            await show_file_manager(callback, server_id, parent_path)
+    @with_state
+    @catch_errors("Parent directory error: %s", "❌ Error navigating to parent directory.")
+    async def parent_directory(callback: types.CallbackQuery, state):
+        server_id = state.server_id
+        
+        current_path = state.current_path
+        parent_path = posixpath.dirname(current_path)
+        
+        # Prevent going above home directory
+        if len(parent_path) < len(state.home_path):
+            parent_path = state.home_path
             
-        except Exception as e:
-            logger.error(f"Parent directory error: {e}")
-            await callback.message.edit_text("❌ Error navigating to parent directory.")
+        state.current_path = parent_path
+        
+        await show_file_manager(callback, server_id, parent_path)
 
     # --- SELECTION MODE ---
-    @dp.callback_query_handler(lambda c: c.data.startswith("fm_select_mode_"))
-    async def toggle_selection_mode(callback: types.CallbackQuery):
-        try:
-            server_id = callback.data.split('_')[3]
-            user_id = callback.from_user.id
-            
-            file_manager_state[user_id]['selection_mode'] = True
-            if user_id not in selected_files:
-                selected_files[user_id] = []
-            
-            current_path = file_manager_state[user_id]['current_path']
-            await show_file_manager(callback, server_id, current_path)
-            
-        except Exception as e:
-            logger.error(f"Selection mode error: {e}")
+    @with_state
+    @catch_errors("Selection mode error: %s")
+    async def toggle_selection_mode(callback: types.CallbackQuery, state):
+        server_id = state.server_id
+        
+        state.selection_mode = True
+        
+        current_path = state.current_path
+        await show_file_manager(callback, server_id, current_path, reuse_listing=True)
 
     # --- CANCEL SELECTION ---
-    @dp.callback_query_handler(lambda c: c.data.startswith("fm_cancel_select_"))
-    async def cancel_selection(callback: types.CallbackQuery):
-        try:
-            server_id = callback.data.split('_')[3]
-            user_id = callback.from_user.id
-            
-            file_manager_state[user_id]['selection_mode'] = False
-            if user_id in selected_files:
-                selected_files[user_id] = []
-            
-            current_path = file_manager_state[user_id]['current_path']
-            await show_file_manager(callback, server_id, current_path)
-            
-        except Exception as e:
-            logger.error(f"Cancel selection error: {e}")
+    @with_state
+    @catch_errors("Cancel selection error: %s")
+    async def cancel_selection(callback: types.CallbackQuery, state):
+        server_id = state.server_id
+        
+        state.selection_mode = False
+        state.selected_files.clear()
+        
+        current_path = state.current_path
+        await show_file_manager(callback, server_id, current_path, reuse_listing=True)
 
     # --- CANCEL OPERATION ---
-    @dp.callback_query_handler(lambda c: c.data.startswith("fm_cancel_op_"))
-    async def cancel_operation(callback: types.CallbackQuery):
-        try:
-            server_id = callback.data.split('_')[3]
-            user_id = callback.from_user.id
-            
-            file_manager_state[user_id]['operation'] = None
-            file_manager_state[user_id]['operation_files'] = []
-            file_manager_state[user_id]['operation_source'] = None
-            
-            current_path = file_manager_state[user_id]['current_path']
-            await show_file_manager(callback, server_id, current_path)
-            
-        except Exception as e:
-            logger.error(f"Cancel operation error: {e}")
+    @with_state
+    @catch_errors("Cancel operation error: %s")
+    async def cancel_operation(callback: types.CallbackQuery, state):
+        server_id = state.server_id
+        
+        state.operation = None
+        state.operation_files = ()
+        state.operation_source = None
+        
+        current_path = state.current_path
+        await show_file_manager(callback, server_id, current_path, reuse_listing=True)
 
     # --- TOGGLE FILE SELECTION ---
-    @dp.callback_query_handler(lambda c: c.data.startswith("fm_toggle_"))
-    async def toggle_file_selection(callback: types.CallbackQuery):
-        try:
-            parts = callback.data.split('_', 3)
-            server_id = parts[2]
-            file_identifier = parts[3]
-            user_id = callback.from_user.id
-            
-            # Get actual filename
-            file_name = get_cached_filename(file_identifier)
-            
-            if user_id not in selected_files:
-                selected_files[user_id] = []
-            
-            if file_name in selected_files[user_id]:
-                selected_files[user_id].remove(file_name)
-            else:
-                selected_files[user_id].append(file_name)
-            
-            current_path = file_manager_state[user_id]['current_path']
-            await show_file_manager(callback, server_id, current_path)
-            
-        except Exception as e:
-            logger.error(f"Toggle selection error: {e}")
+    @with_state
+    @catch_errors("Toggle selection error: %s")
+    async def toggle_file_selection(callback: types.CallbackQuery, state):
+        parts = callback.data.split('_', 3)
+        server_id = state.server_id
+        file_identifier = parts[3]
+        
+        # Get actual filename
+        file_name = get_cached_filename(file_identifier)
+        
+        selected = state.selected_files
+        if file_name in selected:
+            selected.remove(file_name)
+        else:
+            selected.add(file_name)
+        
+        current_path = state.current_path
+        await show_file_manager(callback, server_id, current_path, reuse_listing=True)
 
     # --- FILE ACTIONS MENU ---
-    @dp.callback_query_handler(lambda c: c.data.startswith("fm_actions_"))
-    async def show_actions_menu(callback: types.CallbackQuery):
-        try:
-            server_id = callback.data.split('_')[2]
-            user_id = callback.from_user.id
-            
-            selected_count = len(selected_files.get(user_id, []))
-            
-            kb = InlineKeyboardMarkup(row_width=2)
-            kb.add(
-                InlineKeyboardButton("🗜️ Zip", callback_data=f"fm_action_zip_{server_id}"),
-                InlineKeyboardButton("🗑️ Delete", callback_data=f"fm_action_delete_{server_id}")
-            )
-            kb.add(
-                InlineKeyboardButton("📋 Copy", callback_data=f"fm_action_copy_{server_id}"),
-                InlineKeyboardButton("📁 Move", callback_data=f"fm_action_move_{server_id}")
-            )
-            kb.add(InlineKeyboardButton("⬅️ Back", callback_data=f"fm_cancel_select_{server_id}"))
-            
-            await callback.message.edit_text(
-                f"🔧 <b>Actions for {selected_count} selected items</b>",
-                parse_mode='HTML',
-                reply_markup=kb
-            )
-            
-        except Exception as e:
-            logger.error(f"Actions menu error: {e}")
+    @with_state
+    @catch_errors("Actions menu error: %s")
+    async def show_actions_menu(callback: types.CallbackQuery, state):
+        server_id = state.server_id
+        
+        selected_count = len(state.selected_files)
+        
+        kb = selection_actions_keyboard(server_id)
+        
+        await callback.message.edit_text(
+            f"🔧 <b>Actions for {selected_count} selected items</b>",
+            parse_mode='HTML',
+            reply_markup=kb
+        )
 
     # --- SINGLE FILE MENU ---
-    @dp.callback_query_handler(lambda c: c.data.startswith("fm_file_"))
-    async def show_file_menu(callback: types.CallbackQuery):
-        try:
-            parts = callback.data.split('_', 3)
-            server_id = parts[2]
-            file_identifier = parts[3]
-            
-            # Get actual filename
-            file_name = get_cached_filename(file_identifier)
-            
-            kb = InlineKeyboardMarkup(row_width=2)
-            
-            # Check if it's an archive file
-            is_archive = file_name.lower().endswith(('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz', '.rar', '.7z'))
-            
-            if is_archive:
-                kb.add(
-                    InlineKeyboardButton("📤 Download", callback_data=f"fm_download_{server_id}_{cache_filename(file_name)}"),
-                    InlineKeyboardButton("📦 Extract", callback_data=f"fm_extract_{server_id}_{cache_filename(file_name)}")
-                )
-            else:
-                kb.add(
-                    InlineKeyboardButton("📤 Download", callback_data=f"fm_download_{server_id}_{cache_filename(file_name)}"),
-                    InlineKeyboardButton("🗜️ Zip", callback_data=f"fm_zip_single_{server_id}_{cache_filename(file_name)}")
-                )
-            
-            kb.add(
-                InlineKeyboardButton("✏️ Rename", callback_data=f"fm_rename_{server_id}_{cache_filename(file_name)}"),
-                InlineKeyboardButton("🗑️ Delete", callback_data=f"fm_delete_single_{server_id}_{cache_filename(file_name)}")
-            )
-            kb.add(
-                InlineKeyboardButton("📋 Copy", callback_data=f"fm_copy_single_{server_id}_{cache_filename(file_name)}"),
-                InlineKeyboardButton("📁 Move", callback_data=f"fm_move_single_{server_id}_{cache_filename(file_name)}")
-            )
-            
-            kb.add(InlineKeyboardButton("⬅️ Back", callback_data=f"file_manager_{server_id}"))
-            
-            # Truncate filename for display
-            display_name = file_name[:30] + "..." if len(file_name) > 30 else file_name
-            
-            await callback.message.edit_text(
-                f"📄 <b>{display_name}</b>\n\nChoose an action:",
-                parse_mode='HTML',
-                reply_markup=kb
-            )
-            
-        except Exception as e:
-            logger.error(f"File menu error: {e}")
+    @with_state
+    @catch_errors("File menu error: %s")
+    async def show_file_menu(callback: types.CallbackQuery, state):
+        parts = callback.data.split('_', 3)
+        server_id = state.server_id
+        file_identifier = parts[3]
+        
+        # Get actual filename
+        file_name = get_cached_filename(file_identifier)
+        # Issue the token outside the keyboard cache so it is refreshed in file_name_cache on every open
+        kb = file_menu_keyboard(server_id, file_name, cache_filename(file_name))
+        
+        # Truncate filename for display
+        display_name = file_name[:30] + "..." if len(file_name) > 30 else file_name
+        
+        await callback.message.edit_text(
+            f"📄 <b>{escape_html(display_name)}</b>\n\nChoose an action:",
+            parse_mode='HTML',
+            reply_markup=kb
+        )
 
     # --- NEW FOLDER ---
-    @dp.callback_query_handler(lambda c: c.data.startswith("fm_newfolder_"))
-    async def new_folder_prompt(callback: types.CallbackQuery):
-        try:
-            server_id = callback.data.split('_')[2]
-            user_id = callback.from_user.id
-            
-            user_input[user_id] = {
-                'action': 'new_folder',
-                'server_id': server_id,
-                'path': file_manager_state[user_id]['current_path']
-            }
-            
-            kb = InlineKeyboardMarkup()
-            kb.add(InlineKeyboardButton("❌ Cancel", callback_data=f"file_manager_{server_id}"))
-            
-            await bot.send_message(
-                user_id,
-                "📁 <b>Create New Folder</b>\n\nEnter folder name:",
-                parse_mode='HTML',
-                reply_markup=kb
-            )
-            
-        except Exception as e:
-            logger.error(f"New folder prompt error: {e}")
+    @with_state
+    @catch_errors("New folder prompt error: %s")
+    async def new_folder_prompt(callback: types.CallbackQuery, state):
+        server_id = state.server_id
+        user_id = callback.from_user.id
+        
+        user_input[user_id] = UserInput(action='new_folder', server_id=server_id, path=state.current_path)
+        
+        kb = InlineKeyboardMarkup()
+        kb.add(InlineKeyboardButton("❌ Cancel", callback_data=f"file_manager_{server_id}"))
+        
+        await bot.send_message(
+            user_id,
+            "📁 <b>Create New Folder</b>\n\nEnter folder name:",
+            parse_mode='HTML',
+            reply_markup=kb
+        )
 
     # --- RENAME PROMPT ---
-    @dp.callback_query_handler(lambda c: c.data.startswith("fm_rename_"))
-    async def rename_prompt(callback: types.CallbackQuery):
-        try:
-            parts = callback.data.split('_', 3)
-            server_id = parts[2]
-            file_identifier = parts[3]
-            user_id = callback.from_user.id
-            
-            # Get actual filename
-            file_name = get_cached_filename(file_identifier)
-            
-            user_input[user_id] = {
-                'action': 'rename',
-                'server_id': server_id,
-                'path': file_manager_state[user_id]['current_path'],
-                'old_name': file_name
-            }
-            
-            kb = InlineKeyboardMarkup()
-            kb.add(InlineKeyboardButton("❌ Cancel", callback_data=f"fm_file_{server_id}_{cache_filename(file_name)}"))
-            
-            await bot.send_message(
-                user_id,
-                f"✏️ <b>Rename File</b>\n\nCurrent name: <code>{file_name}</code>\n\nEnter new name:",
-                parse_mode='HTML',
-                reply_markup=kb
-            )
-            
-        except Exception as e:
-            logger.error(f"Rename prompt error: {e}")
+    @with_state
+    @catch_errors("Rename prompt error: %s")
+    async def rename_prompt(callback: types.CallbackQuery, state):
+        parts = callback.data.split('_', 3)
+        server_id = state.server_id
+        file_identifier = parts[3]
+        user_id = callback.from_user.id
+        
+        # Get actual filename
+        file_name = get_cached_filename(file_identifier)
+        
+        user_input[user_id] = UserInput(action='rename', server_id=server_id, path=state.current_path, old_name=file_name)
+        
+        kb = InlineKeyboardMarkup()
+        kb.add(InlineKeyboardButton("❌ Cancel", callback_data=f"fm_file_{server_id}_{cache_filename(file_name)}"))
+        
+        await bot.send_message(
+            user_id,
+            f"✏️ <b>Rename File</b>\n\nCurrent name: <code>{escape_html(file_name)}</code>\n\nEnter new name:",
+            parse_mode='HTML',
+            reply_markup=kb
+        )
 
     # --- DOWNLOAD FILE ---
-    @dp.callback_query_handler(lambda c: c.data.startswith("fm_download_"))
-    async def download_file(callback: types.CallbackQuery):
-        try:
-            parts = callback.data.split('_', 3)
-            server_id = parts[2]
-            file_identifier = parts[3]
-            user_id = callback.from_user.id
-            
-            # Get actual filename
-            file_name = get_cached_filename(file_identifier)
-            
-            current_path = file_manager_state[user_id]['current_path']
-            
-            await callback.message.edit_text("📤 <b>Downloading file...</b>", parse_mode='HTML')
-            
-            # Download file from server
-            file_content = await download_file_from_server(server_id, current_path, file_name, active_sessions)
-            
-            if file_content:
-                # Check file size (Telegram limit is 50MB)
-                if len(file_content) > 50 * 1024 * 1024:
-                    await callback.message.edit_text("❌ <b>File too large for Telegram (>50MB)</b>", parse_mode='HTML')
-                    return
-                
-                # Send file to user
-                with tempfile.NamedTemporaryFile() as temp_file:
-                    temp_file.write(file_content)
-                    temp_file.flush()
-                    
-                    with open(temp_file.name, 'rb') as f:
-                        await bot.send_document(
-                            user_id,
-                            types.InputFile(f, filename=file_name),
-                            caption=f"📄 <b>{file_name}</b>",
-                            parse_mode='HTML'
-                        )
-                
-                kb = InlineKeyboardMarkup()
-                kb.add(InlineKeyboardButton("📂 Back to File Manager", callback_data=f"file_manager_{server_id}"))
-                await callback.message.edit_text("✅ <b>File downloaded successfully!</b>", parse_mode='HTML', reply_markup=kb)
-            else:
-                kb = InlineKeyboardMarkup()
-                kb.add(InlineKeyboardButton("📂 Back to File Manager", callback_data=f"file_manager_{server_id}"))
-                await callback.message.edit_text("❌ <b>Failed to download file</b>", parse_mode='HTML', reply_markup=kb)
+    @with_state
+    @catch_errors("Download file error: %s", "❌ Error downloading file.")
+    async def download_file(callback: types.CallbackQuery, state):
+        parts = callback.data.split('_', 3)
+        server_id = state.server_id
+        file_identifier = parts[3]
+        user_id = callback.from_user.id
+        
+        # Get actual filename
+        file_name = get_cached_filename(file_identifier)
+        
+        current_path = state.current_path
+        
+        await callback.message.edit_text("📤 <b>Downloading file...</b>", parse_mode='HTML')
+        
+        # Download file from server
+        file_obj, error = await download_file_from_server(server_id, current_path, file_name, active_sessions)
+        
+        kb = back_to_file_manager(server_id)
+        
+        if file_obj:
+            # Send file to user straight from the temporary file
+            with file_obj:
+                await bot.send_document(
+                    user_id,
+                    types.InputFile(file_obj, filename=file_name),
+                    caption=f"📄 <b>{escape_html(file_name)}</b>",
+                    parse_mode='HTML'
+                )
             
-        except Exception as e:
-            logger.error(f"Download file error: {e}")
-            await callback.message.edit_text("❌ Error downloading file.")
+            await callback.message.edit_text("✅ <b>File downloaded successfully!</b>", parse_mode='HTML', reply_markup=kb)
+        else:
+            await callback.message.edit_text(f"❌ <b>{escape_html(error)}</b>", parse_mode='HTML', reply_markup=kb)
 
     # --- ZIP OPERATIONS ---
-    @dp.callback_query_handler(lambda c: c.data.startswith("fm_zip_single_") or c.data.startswith("fm_action_zip_"))
-    async def zip_files(callback: types.CallbackQuery):
-        try:
-            if callback.data.startswith("fm_zip_single_"):
-                parts = callback.data.split('_', 4)
-                server_id = parts[3]
-                file_identifier = parts[4]
-                file_name = get_cached_filename(file_identifier)
-                files_to_zip = [file_name]
-            else:
-                server_id = callback.data.split('_')[3]
-                user_id = callback.from_user.id
-                files_to_zip = selected_files.get(user_id, [])
-            
-            if not files_to_zip:
-                await callback.message.edit_text("❌ No files selected for zipping.")
-                return
-            
-            user_id = callback.from_user.id
-            current_path = file_manager_state[user_id]['current_path']
-            
-            await callback.message.edit_text("🗜️ <b>Creating zip archive...</b>", parse_mode='HTML')
-            
-            # Create zip file on server
-            zip_name = f"archive_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
-            success = await create_zip_on_server(server_id, current_path, files_to_zip, zip_name, active_sessions)
-            
-            if success:
-                # Clear selection if it was bulk operation
-                if user_id in selected_files:
-                    selected_files[user_id] = []
-                    file_manager_state[user_id]['selection_mode'] = False
-                
-                kb = InlineKeyboardMarkup()
-                kb.add(InlineKeyboardButton("📂 Back to File Manager", callback_data=f"file_manager_{server_id}"))
-                await callback.message.edit_text(
-                    f"✅ <b>Zip created successfully!</b>\n\nFile: <code>{zip_name}</code>",
-                    parse_mode='HTML',
-                    reply_markup=kb
-                )
-            else:
-                kb = InlineKeyboardMarkup()
-                kb.add(InlineKeyboardButton("📂 Back to File Manager", callback_data=f"file_manager_{server_id}"))
-                await callback.message.edit_text("❌ <b>Failed to create zip archive</b>", parse_mode='HTML', reply_markup=kb)
+    @with_state
+    @catch_errors("Zip files error: %s", "❌ Error creating zip archive.")
+    async def zip_files(callback: types.CallbackQuery, state):
+        # fm_zip_single_<server>_<file> or fm_action_zip_<server>, split once
+        parts = callback.data.split('_', 4)
+        server_id = state.server_id
+        if parts[2] == 'single':
+            file_name = get_cached_filename(parts[4])
+            files_to_zip = [file_name]
+        else:
+            files_to_zip = list(state.selected_files)
+        
+        if not files_to_zip:
+            await callback.message.edit_text("❌ No files selected for zipping.")
+            return
+        
+        current_path = state.current_path
+        
+        await callback.message.edit_text("🗜️ <b>Creating zip archive...</b>", parse_mode='HTML')
+        
+        # Create zip file on server
+        zip_name = f"archive_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
+        success = await create_zip_on_server(server_id, current_path, files_to_zip, zip_name, active_sessions)
+        
+        # Refill the invalidated listing while the result is on screen, so Back finds it cached
+        spawn(get_file_listing(server_id, current_path, active_sessions))
+        
+        if success:
+            # Clear selection if it was bulk operation
+            state.selected_files.clear()
+            state.selection_mode = False
             
-        except Exception as e:
-            logger.error(f"Zip files error: {e}")
-            await callback.message.edit_text("❌ Error creating zip archive.")
+            kb = back_to_file_manager(server_id)
+            await callback.message.edit_text(
+                f"✅ <b>Zip created successfully!</b>\n\nFile: <code>{escape_html(zip_name)}</code>",
+                parse_mode='HTML',
+                reply_markup=kb
+            )
+        else:
+            kb = back_to_file_manager(server_id)
+            await callback.message.edit_text("❌ <b>Failed to create zip archive</b>", parse_mode='HTML', reply_markup=kb)
 
     # --- EXTRACT OPERATION ---
-    @dp.callback_query_handler(lambda c: c.data.startswith("fm_extract_"))
-    async def extract_file(callback: types.CallbackQuery):
-        try:
-            parts = callback.data.split('_', 3)
-            server_id = parts[2]
-            file_identifier = parts[3]
-            user_id = callback.from_user.id
-            
-            # Get actual filename
-            file_name = get_cached_filename(file_identifier)
-            
-            current_path = file_manager_state[user_id]['current_path']
-            
-            await callback.message.edit_text("📦 <b>Extracting archive...</b>", parse_mode='HTML')
-            
-            # Extract archive on server
+    @with_state
+    @catch_errors("Extract file error: %s", "❌ Error extracting archive.")
+    async def extract_file(callback: types.CallbackQuery, state):
+        parts = callback.data.split('_', 3)
+        server_id = state.server_id
+        file_identifier = parts[3]
+        
+        # Get actual filename
+        file_name = get_cached_filename(file_identifier)
+        
+        current_path = state.current_path
+        
+        await callback.message.edit_text("📦 <b>Extracting archive...</b>", parse_mode='HTML')
+        
+        # Large archives take a while; finish in the background so the user's next taps aren't held up
+        spawn(finish_extract(callback, server_id, current_path, file_name))
+    
+    @catch_errors("Extract file error: %s", "❌ Error extracting archive.")
+    async def finish_extract(callback, server_id, current_path, file_name):
+        async with archive_slot(server_id):
             success = await extract_archive_on_server(server_id, current_path, file_name, active_sessions)
-            
-            if success:
-                kb = InlineKeyboardMarkup()
-                kb.add(InlineKeyboardButton("📂 Back to File Manager", callback_data=f"file_manager_{server_id}"))
-                await callback.message.edit_text(
-                    f"✅ <b>Archive extracted successfully!</b>\n\nFile: <code>{file_name}</code>",
-                    parse_mode='HTML',
-                    reply_markup=kb
-                )
-            else:
-                kb = InlineKeyboardMarkup()
-                kb.add(InlineKeyboardButton("📂 Back to File Manager", callback_data=f"file_manager_{server_id}"))
-                await callback.message.edit_text("❌ <b>Failed to extract archive</b>", parse_mode='HTML', reply_markup=kb)
-            
-        except Exception as e:
-            logger.error(f"Extract file error: {e}")
-            await callback.message.edit_text("❌ Error extracting archive.")
+        
+        spawn(get_file_listing(server_id, current_path, active_sessions))
+        
+        if success:
+            kb = back_to_file_manager(server_id)
+            await callback.message.edit_text(
+                f"✅ <b>Archive extracted successfully!</b>\n\nFile: <code>{escape_html(file_name)}</code>",
+                parse_mode='HTML',
+                reply_markup=kb
+            )
+        else:
+            kb = back_to_file_manager(server_id)
+            await callback.message.edit_text("❌ <b>Failed to extract archive</b>", parse_mode='HTML', reply_markup=kb)
 
     # --- COPY OPERATIONS ---
-    @dp.callback_query_handler(lambda c: c.data.startswith("fm_copy_single_") or c.data.startswith("fm_action_copy_"))
-    async def copy_files_start(callback: types.CallbackQuery):
-        try:
-            if callback.data.startswith("fm_copy_single_"):
-                parts = callback.data.split('_', 4)
-                server_id = parts[3]
-                file_identifier = parts[4]
-                file_name = get_cached_filename(file_identifier)
-                files_to_copy = [file_name]
-            else:
-                server_id = callback.data.split('_')[3]
-                user_id = callback.from_user.id
-                files_to_copy = selected_files.get(user_id, [])
-            
-            if not files_to_copy:
-                await callback.message.edit_text("❌ No files selected for copying.")
-                return
-            
-            user_id = callback.from_user.id
-            
-            # Set operation state
-            file_manager_state[user_id]['operation'] = 'copy'
-            file_manager_state[user_id]['operation_files'] = files_to_copy
-            file_manager_state[user_id]['operation_source'] = file_manager_state[user_id]['current_path']
-            file_manager_state[user_id]['selection_mode'] = False
-            
-            current_path = file_manager_state[user_id]['current_path']
-            await show_file_manager(callback, server_id, current_path)
-            
-        except Exception as e:
-            logger.error(f"Copy files start error: {e}")
+    @with_state
+    @catch_errors("Copy files start error: %s")
+    async def copy_files_start(callback: types.CallbackQuery, state):
+        # fm_copy_single_<server>_<file> or fm_action_copy_<server>, split once
+        parts = callback.data.split('_', 4)
+        server_id = state.server_id
+        if parts[2] == 'single':
+            file_name = get_cached_filename(parts[4])
+            files_to_copy = (file_name,)
+        else:
+            files_to_copy = tuple(state.selected_files)
+        
+        if not files_to_copy:
+            await callback.message.edit_text("❌ No files selected for copying.")
+            return
+        
+        # Set operation state
+        state.operation = 'copy'
+        state.operation_files = files_to_copy
+        state.operation_source = state.current_path
+        state.selection_mode = False
+        
+        current_path = state.current_path
+        await show_file_manager(callback, server_id, current_path, reuse_listing=True)
 
     # --- MOVE OPERATIONS ---
-    @dp.callback_query_handler(lambda c: c.data.startswith("fm_move_single_") or c.data.startswith("fm_action_move_"))
-    async def move_files_start(callback: types.CallbackQuery):
-        try:
-            if callback.data.startswith("fm_move_single_"):
-                parts = callback.data.split('_', 4)
-                server_id = parts[3]
-                file_identifier = parts[4]
-                file_name = get_cached_filename(file_identifier)
-                files_to_move = [file_name]
-            else:
-                server_id = callback.data.split('_')[3]
-                user_id = callback.from_user.id
-                files_to_move = selected_files.get(user_id, [])
-            
-            if not files_to_move:
-                await callback.message.edit_text("❌ No files selected for moving.")
-                return
-            
-            user_id = callback.from_user.id
-            
-            # Set operation state
-            file_manager_state[user_id]['operation'] = 'move'
-            file_manager_state[user_id]['operation_files'] = files_to_move
-            file_manager_state[user_id]['operation_source'] = file_manager_state[user_id]['current_path']
-            file_manager_state[user_id]['selection_mode'] = False
-            
-            current_path = file_manager_state[user_id]['current_path']
-            await show_file_manager(callback, server_id, current_path)
-            
-        except Exception as e:
-            logger.error(f"Move files start error: {e}")
+    @with_state
+    @catch_errors("Move files start error: %s")
+    async def move_files_start(callback: types.CallbackQuery, state):
+        # fm_move_single_<server>_<file> or fm_action_move_<server>, split once
+        parts = callback.data.split('_', 4)
+        server_id = state.server_id
+        if parts[2] == 'single':
+            file_name = get_cached_filename(parts[4])
+            files_to_move = (file_name,)
+        else:
+            files_to_move = tuple(state.selected_files)
+        
+        if not files_to_move:
+            await callback.message.edit_text("❌ No files selected for moving.")
+            return
+        
+        # Set operation state
+        state.operation = 'move'
+        state.operation_files = files_to_move
+        state.operation_source = state.current_path
+        state.selection_mode = False
+        
+        current_path = state.current_path
+        await show_file_manager(callback, server_id, current_path, reuse_listing=True)
 
     # --- EXECUTE COPY/MOVE ---
-    @dp.callback_query_handler(lambda c: c.data.startswith("fm_exec_"))
-    async def execute_operation(callback: types.CallbackQuery):
-        try:
-            parts = callback.data.split('_')
-            operation = parts[2]  # copy or move
-            server_id = parts[3]
-            user_id = callback.from_user.id
-            
-            source_path = file_manager_state[user_id]['operation_source']
-            dest_path = file_manager_state[user_id]['current_path']
-            files = file_manager_state[user_id]['operation_files']
-            
-            if source_path == dest_path:
-                await callback.message.edit_text("❌ Source and destination are the same!")
-                return
-            
-            await callback.message.edit_text(f"🔄 <b>{operation.title()}ing files...</b>", parse_mode='HTML')
-            
-            if operation == 'copy':
-                success = await copy_files_on_server(server_id, source_path, files, dest_path, active_sessions)
-            else:  # move
-                success = await move_files_on_server(server_id, source_path, files, dest_path, active_sessions)
-            
-            # Clear operation state
-            file_manager_state[user_id]['operation'] = None
-            file_manager_state[user_id]['operation_files'] = []
-            file_manager_state[user_id]['operation_source'] = None
-            
-            if user_id in selected_files:
-                selected_files[user_id] = []
-            
-            if success:
-                kb = InlineKeyboardMarkup()
-                kb.add(InlineKeyboardButton("📂 Back to File Manager", callback_data=f"file_manager_{server_id}"))
-                await callback.message.edit_text(
-                    f"✅ <b>Files {operation}d successfully!</b>\n\n{operation.title()}d {len(files)} items.",
-                    parse_mode='HTML',
-                    reply_markup=kb
-                )
-            else:
-                kb = InlineKeyboardMarkup()
-                kb.add(InlineKeyboardButton("📂 Back to File Manager", callback_data=f"file_manager_{server_id}"))
-                await callback.message.edit_text(f"❌ <b>Failed to {operation} files</b>", parse_mode='HTML', reply_markup=kb)
-            
-        except Exception as e:
-            logger.error(f"Execute operation error: {e}")
-            await callback.message.edit_text(f"❌ Error executing {operation} operation.")
+    @with_state
+    @catch_errors("Execute operation error: %s", "❌ Error executing copy/move operation.")
+    async def execute_operation(callback: types.CallbackQuery, state):
+        parts = callback.data.split('_')
+        operation = parts[2]  # copy or move
+        server_id = state.server_id
+        
+        source_path = state.operation_source
+        dest_path = state.current_path
+        files = state.operation_files
+        
+        if source_path == dest_path:
+            await callback.message.edit_text("❌ Source and destination are the same!")
+            return
+        
+        await callback.message.edit_text(f"🔄 <b>{operation.title()}ing files...</b>", parse_mode='HTML')
+        
+        if operation == 'copy':
+            success = await copy_files_on_server(server_id, source_path, files, dest_path, active_sessions)
+        else:  # move
+            success = await move_files_on_server(server_id, source_path, files, dest_path, active_sessions)
+        
+        # Clear operation state
+        state.operation = None
+        state.operation_files = ()
+        state.operation_source = None
+        
+        state.selected_files.clear()
+        
+        if success:
+            kb = back_to_file_manager(server_id)
+            await callback.message.edit_text(
+                f"✅ <b>Files {operation}d successfully!</b>\n\n{operation.title()}d {len(files)} items.",
+                parse_mode='HTML',
+                reply_markup=kb
+            )
+        else:
+            kb = back_to_file_manager(server_id)
+            await callback.message.edit_text(f"❌ <b>Failed to {operation} files</b>", parse_mode='HTML', reply_markup=kb)
 
     # --- DELETE CONFIRMATION ---
-    @dp.callback_query_handler(lambda c: c.data.startswith("fm_action_delete_") or c.data.startswith("fm_delete_single_"))
-    async def delete_confirmation(callback: types.CallbackQuery):
-        try:
-            if callback.data.startswith("fm_action_delete_"):
-                server_id = callback.data.split('_')[3]
-                user_id = callback.from_user.id
-                files_to_delete = selected_files.get(user_id, [])
-                
-                kb = InlineKeyboardMarkup(row_width=2)
-                kb.add(
-                    InlineKeyboardButton("✅ Yes, Delete", callback_data=f"fm_confirm_delete_{server_id}"),
-                    InlineKeyboardButton("❌ Cancel", callback_data=f"fm_actions_{server_id}")
-                )
-                
-                await callback.message.edit_text(
-                    f"⚠️ <b>Confirm Deletion</b>\n\nAre you sure you want to delete {len(files_to_delete)} selected items?\n\n<b>This action cannot be undone!</b>",
-                    parse_mode='HTML',
-                    reply_markup=kb
-                )
-            else:
-                parts = callback.data.split('_', 4)
-                server_id = parts[3]
-                file_identifier = parts[4]
-                file_name = get_cached_filename(file_identifier)
-                
-                kb = InlineKeyboardMarkup(row_width=2)
-                kb.add(
-                    InlineKeyboardButton("✅ Yes, Delete", callback_data=f"fm_confirm_delete_single_{server_id}_{cache_filename(file_name)}"),
-                    InlineKeyboardButton("❌ Cancel", callback_data=f"fm_file_{server_id}_{cache_filename(file_name)}")
-                )
-                
-                display_name = file_name[:30] + "..." if len(file_name) > 30 else file_name
-                await callback.message.edit_text(
-                    f"⚠️ <b>Confirm Deletion</b>\n\nAre you sure you want to delete:\n<code>{display_name}</code>\n\n<b>This action cannot be undone!</b>",
-                    parse_mode='HTML',
-                    reply_markup=kb
-                )
-                
-        except Exception as e:
-            logger.error(f"Delete confirmation error: {e}")
-
-    # --- CONFIRM DELETE ---
-    @dp.callback_query_handler(lambda c: c.data.startswith("fm_confirm_delete_"))
-    async def confirm_delete(callback: types.CallbackQuery):
-        try:
-            if callback.data.startswith("fm_confirm_delete_single_"):
-                parts = callback.data.split('_', 5)
-                server_id = parts[4]
-                file_identifier = parts[5]
-                file_name = get_cached_filename(file_identifier)
-                files_to_delete = [file_name]
-            else:
-                server_id = callback.data.split('_')[3]
-                user_id = callback.from_user.id
-                files_to_delete = selected_files.get(user_id, [])
+    @with_state
+    @catch_errors("Delete confirmation error: %s")
+    async def delete_confirmation(callback: types.CallbackQuery, state):
+        # fm_action_delete_<server> or fm_delete_single_<server>_<file>, split once
+        parts = callback.data.split('_', 4)
+        server_id = state.server_id
+        if parts[1] == 'action':
+            # Only the count is shown, no need to copy the selection
+            selected_count = len(state.selected_files)
             
-            if not files_to_delete:
-                await callback.message.edit_text("❌ No files selected for deletion.")
-                return
-            
-            user_id = callback.from_user.id
-            current_path = file_manager_state[user_id]['current_path']
-            
-            await callback.message.edit_text("🗑️ <b>Deleting files...</b>", parse_mode='HTML')
-            
-            # Delete files on server
-            success = await delete_files_on_server(server_id, current_path, files_to_delete, active_sessions)
-            
-            if success:
-                # Clear selection if it was bulk operation
-                if user_id in selected_files:
-                    selected_files[user_id] = []
-                    file_manager_state[user_id]['selection_mode'] = False
-                
-                kb = InlineKeyboardMarkup()
-                kb.add(InlineKeyboardButton("📂 Back to File Manager", callback_data=f"file_manager_{server_id}"))
-                await callback.message.edit_text(
-                    f"✅ <b>Files deleted successfully!</b>\n\nDeleted {len(files_to_delete)} items.",
-                    parse_mode='HTML',
-                    reply_markup=kb
-                )
-            else:
-                kb = InlineKeyboardMarkup()
-                kb.add(InlineKeyboardButton("📂 Back to File Manager", callback_data=f"file_manager_{server_id}"))
-                await callback.message.edit_text("❌ <b>Failed to delete some files</b>", parse_mode='HTML', reply_markup=kb)
-            
-        except Exception as e:
-            logger.error(f"Confirm delete error: {e}")
-            await callback.message.edit_text("❌ Error deleting files.")
-
-    # --- UPLOAD HANDLER ---
-    @dp.callback_query_handler(lambda c: c.data.startswith("fm_upload_"))
-    async def upload_prompt(callback: types.CallbackQuery):
-        try:
-            server_id = callback.data.split('_')[2]
-            user_id = callback.from_user.id
-            
-            user_input[user_id] = {
-                'action': 'upload',
-                'server_id': server_id,
-                'path': file_manager_state[user_id]['current_path']
-            }
+            await callback.message.edit_text(
+                f"⚠️ <b>Confirm Deletion</b>\n\nAre you sure you want to delete {selected_count} selected items?\n\n<b>This action cannot be undone!</b>",
+                parse_mode='HTML',
+                reply_markup=bulk_delete_keyboard(server_id)
+            )
+        else:
+            # The identifier is already the cached form of the name
+            cached_name = parts[4]
+            file_name = get_cached_filename(cached_name)
             
-            kb = InlineKeyboardMarkup()
-            kb.add(InlineKeyboardButton("❌ Cancel", callback_data=f"file_manager_{server_id}"))
+            kb = InlineKeyboardMarkup(row_width=2)
+            kb.add(
+                InlineKeyboardButton("✅ Yes, Delete", callback_data=f"fm_confirm_delete_single_{server_id}_{cached_name}"),
+                InlineKeyboardButton("❌ Cancel", callback_data=f"fm_file_{server_id}_{cached_name}")
+            )
             
-            await bot.send_message(
-                user_id,
-                "📤 <b>Upload File</b>\n\n"
-                "Send any file you want to upload to the server:\n\n"
-                "📋 <b>Supported types:</b>\n"
-                "• Documents (PDF, DOC, TXT, etc.)\n"
-                "• Images (JPG, PNG, GIF, etc.)\n"
-                "• Videos (MP4, AVI, MOV, etc.)\n"
-                "• Audio (MP3, WAV, OGG, etc.)\n"
-                "• Archives (ZIP, RAR, TAR, etc.)\n"
-                "• Any other file type\n\n"
-                "📏 <b>Max size:</b> 50MB",
+            display_name = file_name[:30] + "..." if len(file_name) > 30 else file_name
+            await callback.message.edit_text(
+                f"⚠️ <b>Confirm Deletion</b>\n\nAre you sure you want to delete:\n<code>{escape_html(display_name)}</code>\n\n<b>This action cannot be undone!</b>",
                 parse_mode='HTML',
                 reply_markup=kb
             )
+
+    # --- CONFIRM DELETE ---
+    @with_state
+    @catch_errors("Confirm delete error: %s", "❌ Error deleting files.")
+    async def confirm_delete(callback: types.CallbackQuery, state):
+        # fm_confirm_delete_single_<server>_<file> or fm_confirm_delete_<server>, split once
+        server_id = state.server_id
+        parts = callback.data.split('_', 5)
+        if parts[3] == 'single':
+            files_to_delete = [get_cached_filename(parts[5])]
+        else:
+            files_to_delete = list(state.selected_files)
+        
+        if not files_to_delete:
+            await callback.message.edit_text("❌ No files selected for deletion.")
+            return
+        
+        current_path = state.current_path
+        
+        await callback.message.edit_text("🗑️ <b>Deleting files...</b>", parse_mode='HTML')
+        
+        # Delete files on server
+        success = await delete_files_on_server(server_id, current_path, files_to_delete, active_sessions)
+        
+        if success:
+            # Clear selection if it was bulk operation
+            state.selected_files.clear()
+            state.selection_mode = False
             
-        except Exception as e:
-            logger.error(f"Upload prompt error: {e}")
+            # Report as a toast and go straight back to the (locally pruned) listing
+            await callback.answer(f"✅ Deleted {len(files_to_delete)} items")
+            await show_file_manager(callback, server_id, current_path)
+        else:
+            kb = back_to_file_manager(server_id)
+            await callback.message.edit_text("❌ <b>Failed to delete some files</b>", parse_mode='HTML', reply_markup=kb)
+
+    # --- UPLOAD HANDLER ---
+    @with_state
+    @catch_errors("Upload prompt error: %s")
+    async def upload_prompt(callback: types.CallbackQuery, state):
+        server_id = state.server_id
+        user_id = callback.from_user.id
+        
+        user_input[user_id] = UserInput(action='upload', server_id=server_id, path=state.current_path)
+        
+        kb = InlineKeyboardMarkup()
+        kb.add(InlineKeyboardButton("❌ Cancel", callback_data=f"file_manager_{server_id}"))
+        
+        await bot.send_message(
+            user_id,
+            "📤 <b>Upload File</b>\n\n"
+            "Send any file you want to upload to the server:\n\n"
+            "📋 <b>Supported types:</b>\n"
+            "• Documents (PDF, DOC, TXT, etc.)\n"
+            "• Images (JPG, PNG, GIF, etc.)\n"
+            "• Videos (MP4, AVI, MOV, etc.)\n"
+            "• Audio (MP3, WAV, OGG, etc.)\n"
+            "• Archives (ZIP, RAR, TAR, etc.)\n"
+            "• Any other file type\n\n"
+            "📏 <b>Max size:</b> 50MB",
+            parse_mode='HTML',
+            reply_markup=kb
+        )
 
     # --- HANDLE TEXT INPUTS ---
-    @dp.message_handler(lambda message: message.from_user.id in user_input and user_input[message.from_user.id].get('action') in ['new_folder', 'rename'])
+    @dp.message_handler(lambda message: getattr(user_input.get(message.from_user.id), 'action', None) in ('new_folder', 'rename'))
     async def handle_text_input(message: types.Message):
         try:
             user_id = message.from_user.id
             data = user_input[user_id]
-            action = data['action']
-            server_id = data['server_id']
+            action = data.action
+            server_id = data.server_id
             
             if action == 'new_folder':
                 folder_name = message.text.strip()
-                if not folder_name or '/' in folder_name or folder_name in ['.', '..']:
+                if not folder_name or sanitize_filename(folder_name) != folder_name:
                     await message.answer("❌ Invalid folder name. Please try again.")
                     return
                 
-                success = await create_folder(server_id, data['path'], folder_name, active_sessions)
-                if success:
-                    await message.answer("✅ Folder created successfully!")
-                else:
-                    await message.answer("❌ Failed to create folder.")
+                success = await create_folder(server_id, data.path, folder_name, active_sessions)
+                result = "✅ Folder created successfully!" if success else "❌ Failed to create folder."
                     
             elif action == 'rename':
                 new_name = message.text.strip()
-                if not new_name or '/' in new_name or new_name in ['.', '..']:
+                if not new_name or sanitize_filename(new_name) != new_name:
                     await message.answer("❌ Invalid name. Please try again.")
                     return
                 
-                success = await rename_item(server_id, data['path'], data['old_name'], new_name, active_sessions)
-                if success:
-                    await message.answer("✅ Renamed successfully!")
-                else:
-                    await message.answer("❌ Failed to rename.")
+                success = await rename_item(server_id, data.path, data.old_name, new_name, active_sessions)
+                result = "✅ Renamed successfully!" if success else "❌ Failed to rename."
             
             user_input.pop(user_id, None)
             
-            # Return to file manager
-            kb = InlineKeyboardMarkup()
-            kb.add(InlineKeyboardButton("📂 Back to File Manager", callback_data=f"file_manager_{server_id}"))
-            await message.answer("Choose an option:", reply_markup=kb)
+            # Report the result with the way back to the file manager in one message
+            await message.answer(result, reply_markup=back_to_file_manager(server_id))
             
         except Exception as e:
-            logger.error(f"Handle text input error: {e}")
+            logger.error("Handle text input error: %s", e)
             await message.answer("❌ Error processing input.")
 
     # --- HANDLE FILE UPLOADS ---
@@ -849,13 +1063,13 @@ def init_file_manager(dp, bot, active_sessions, user_input):
     async def handle_file_upload(message: types.Message):
         try:
             user_id = message.from_user.id
-            if user_id not in user_input or user_input[user_id].get('action') != 'upload':
+            data = user_input.get(user_id)
+            if data is None or data.action != 'upload':
                 return
             
-            data = user_input[user_id]
-            server_id = data['server_id']
+            server_id = data.server_id
             
-            await message.answer("📤 <b>Uploading file...</b>", parse_mode='HTML')
+            status = await message.answer("📤 <b>Uploading file...</b>", parse_mode='HTML')
             
             # Handle different file types
             file_obj = None
@@ -887,381 +1101,456 @@ def init_file_manager(dp, bot, active_sessions, user_input):
                 filename = message.animation.file_name or f"animation_{datetime.now().strftime('%Y%m%d_%H%M%S')}.gif"
             
             if not file_obj:
-                await message.answer("❌ Unsupported file type.")
+                await status.edit_text("❌ Unsupported file type.")
                 return
             
+            # Client-supplied names must not escape the current directory
+            filename = sanitize_filename(filename) or f"file_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+            
             # Check file size
-            if hasattr(file_obj, 'file_size') and file_obj.file_size and file_obj.file_size > 50 * 1024 * 1024:
-                await message.answer("❌ File too large (>50MB).")
+            if hasattr(file_obj, 'file_size') and file_obj.file_size and file_obj.file_size > MAX_FILE_SIZE:
+                await status.edit_text(f"❌ File too large (>{MAX_FILE_SIZE // (1024 * 1024)}MB).")
                 return
             
-            # Download file from Telegram
-            file = await bot.download_file_by_id(file_obj.file_id)
-            file_content = file.read()
+            # Stream from Telegram into a temporary file, then on to the server
+            with tempfile.TemporaryFile() as local_file:
+                await bot.download_file_by_id(file_obj.file_id, destination=local_file)
+                success = await upload_file(server_id, data.path, filename, local_file, active_sessions)
             
-            # Upload to server
-            success = await upload_file(server_id, data['path'], filename, file_content, active_sessions)
+            user_input.pop(user_id, None)
             
+            # Turn the progress message into the result, with the way back to the file manager
             if success:
-                await message.answer(f"✅ <b>File uploaded successfully!</b>\n\nFilename: <code>{filename}</code>", parse_mode='HTML')
+                result = f"✅ <b>File uploaded successfully!</b>\n\nFilename: <code>{escape_html(filename)}</code>"
             else:
-                await message.answer("❌ Failed to upload file.")
-            
-            user_input.pop(user_id, None)
-            
-            # Return to file manager
-            kb = InlineKeyboardMarkup()
-            kb.add(InlineKeyboardButton("📂 Back to File Manager", callback_data=f"file_manager_{server_id}"))
-            await message.answer("Choose an option:", reply_markup=kb)
+                result = "❌ Failed to upload file."
+            await status.edit_text(result, parse_mode='HTML', reply_markup=back_to_file_manager(server_id))
             
         except Exception as e:
-            logger.error(f"File upload error: {e}")
+            logger.error("File upload error: %s", e)
             await message.answer("❌ Error uploading file.")
 
     # --- NO-OP HANDLER ---
-    @dp.callback_query_handler(lambda c: c.data == "fm_noop")
     async def noop_handler(callback: types.CallbackQuery):
         await callback.answer()
 
-# --- HELPER FUNCTIONS ---
-
-async def get_current_user(server_id, active_sessions):
-    """Get current username for the server"""
-    try:
-        from db import get_server_by_id
-        server = await get_server_by_id(server_id)
-        return server['username'] if server else 'user'
-    except:
-        return 'user'
-
-async def get_file_listing(server_id, path, active_sessions):
-    """Get file listing from remote server"""
-    try:
-        if server_id not in active_sessions:
-            return None
-        
-        ssh = active_sessions[server_id]
+    # --- CALLBACK DISPATCH ---
+    # Action keyword(s) after "fm_" -> handler; one filter and one dict lookup per callback
+    fm_actions = {
+        'enter': enter_directory,
+        'parent': parent_directory,
+        'select_mode': toggle_selection_mode,
+        'cancel_select': cancel_selection,
+        'cancel_op': cancel_operation,
+        'toggle': toggle_file_selection,
+        'actions': show_actions_menu,
+        'file': show_file_menu,
+        'newfolder': new_folder_prompt,
+        'rename': rename_prompt,
+        'download': download_file,
+        'zip_single': zip_files,
+        'action_zip': zip_files,
+        'extract': extract_file,
+        'copy_single': copy_files_start,
+        'action_copy': copy_files_start,
+        'move_single': move_files_start,
+        'action_move': move_files_start,
+        'exec': execute_operation,
+        'action_delete': delete_confirmation,
+        'delete_single': delete_confirmation,
+        'confirm_delete': confirm_delete,
+        'upload': upload_prompt,
+        'noop': noop_handler,
+    }
+    
+    @dp.callback_query_handler(lambda c: c.data.startswith("fm_"))
+    async def file_manager_dispatch(callback: types.CallbackQuery):
+        data = callback.data
         
-        # Execute ls command with detailed info
-        command = f"ls -la '{path}' 2>/dev/null"
-        stdin, stdout, stderr = ssh.exec_command(command)
-        output = stdout.read().decode().strip()
-        error = stderr.read().decode().strip()
+        # Drop repeated taps and redelivered callbacks for the same button
+        now = time.monotonic()
+        previous = last_callback.get(callback.from_user.id)
+        last_callback[callback.from_user.id] = (data, now)
+        if previous and previous[0] == data and now - previous[1] < DUPLICATE_TAP_WINDOW:
+            await callback.answer()
+            return
         
-        if error:
-            logger.error(f"ls command error: {error}")
-            return None
-        
-        files = []
-        lines = output.split('\n')[1:]  # Skip total line
+        # Slice out the action word(s) after "fm_" instead of splitting the whole payload;
+        # two-word actions take precedence over their one-word prefix
+        first = data.find('_', 3)
+        if first == -1:
+            handler = fm_actions.get(data[3:])
+        else:
+            second = data.find('_', first + 1)
+            handler = (second != -1 and fm_actions.get(data[3:second])) or fm_actions.get(data[3:first])
+        if handler is None:
+            logger.debug("Unknown file manager callback: %s", callback.data)
+            await callback.answer()
+            return
         
-        for line in lines:
-            if not line.strip():
-                continue
-                
-            parts = line.split()
-            if len(parts) < 9:
-                continue
-            
-            permissions = parts[0]
-            name = ' '.join(parts[8:])
-            
-            if name in ['.']:
-                continue
-            
-            file_type = 'directory' if permissions.startswith('d') else 'file'
-            files.append({
-                'name': name,
-                'type': file_type,
-                'permissions': permissions,
-                'size': parts[4] if file_type == 'file' else None
-            })
+        # Return to the dispatcher at once; the user's own taps still run in order
+        enqueue_callback(callback.from_user.id, handler(callback))
+
+# --- HELPER FUNCTIONS ---
+
+async def acquire_session(server_id):
+    """Return the server's SSH session, reconnecting once if it has dropped"""
+    ssh = await run_blocking(get_live_session, server_id)
+    if ssh is not None:
+        return ssh
+    
+    # One reconnect per server, concurrent callers reuse its result
+    lock = session_locks.setdefault(server_id, asyncio.Lock())
+    async with lock:
+        ssh = await run_blocking(get_live_session, server_id)
+        if ssh is not None:
+            return ssh
         
-        # Sort: directories first, then files
-        files.sort(key=lambda x: (x['type'] == 'file', x['name'].lower()))
+        server = await get_server_cached(server_id)
+        if not server:
+            return None
+        try:
+            return await run_blocking(get_ssh_session, server_id, server['ip'], server['username'], server['key_content'])
+        except Exception as e:
+            logger.warning("Could not reconnect to %s: %s", server_id, e)
+            return None
+
+def parse_sftp_attrs(attrs):
+    """Turn SFTP directory attributes into file entries with their button label and token"""
+    files = []
+    
+    for attr in attrs:
+        name = attr.filename
+        # Button text and callback token, reused by every render of this listing
+        files.append(FileEntry(
+            name,
+            stat.S_ISDIR(attr.st_mode or 0),
+            name[:25] + "..." if len(name) > 25 else name,
+            cache_filename(name)
+        ))
+    
+    return files
+
+async def get_file_listing(server_id, path, active_sessions, reuse=False):
+    """Get file listing from remote server, reuse=True accepts a cached listing of any age"""
+    try:
+        # Serve repeated navigation from the cache
+        cached = listing_cache.get((server_id, path))
+        if cached and (reuse or time.monotonic() - cached[0] < LISTING_CACHE_TTL):
+            return list(cached[1])
         
-        return files
+        # A burst of refreshes on the same directory waits for a single READDIR
+        lock = listing_locks.setdefault((server_id, path), asyncio.Lock())
+        async with lock:
+            cached = listing_cache.get((server_id, path))
+            if cached and time.monotonic() - cached[0] < LISTING_CACHE_TTL:
+                return list(cached[1])
+            
+            ssh = await acquire_session(server_id)
+            if ssh is None:
+                logger.debug("No active SSH session for server %s", server_id)
+                return None
+            
+            # Structured attributes straight from SFTP READDIR, no shell command or text parsing
+            try:
+                attrs = await run_blocking(list_directory, ssh, path)
+            except IOError as e:
+                logger.warning("Cannot list %s: %s", path, e)
+                return None
+            
+            files = parse_sftp_attrs(attrs)
+            
+            # Sort: directories first, then files
+            files.sort(key=lambda x: (not x.is_dir, x.name.lower()))
+            
+            listing_cache[(server_id, path)] = (time.monotonic(), files)
+            return list(files)
         
     except Exception as e:
-        logger.error(f"Get file listing error: {e}")
+        logger.error("Get file listing error: %s", e)
         return None
 
 async def create_folder(server_id, path, folder_name, active_sessions):
     """Create a new folder"""
     try:
-        if server_id not in active_sessions:
+        ssh = await acquire_session(server_id)
+        if ssh is None:
+            logger.debug("No active SSH session for server %s", server_id)
             return False
+        folder_path = posixpath.join(path, folder_name)
         
-        ssh = active_sessions[server_id]
-        folder_path = os.path.join(path, folder_name).replace('\\', '/')
-        
-        command = f"mkdir '{folder_path}'"
-        stdin, stdout, stderr = ssh.exec_command(command)
-        error = stderr.read().decode().strip()
+        command = f"mkdir -- {shlex.quote(folder_path)}"
+        _, error = await run_blocking(execute_ssh_command, ssh, command)
+        error = error.strip()
+        invalidate_listing(server_id, path)
         
         return not error
         
     except Exception as e:
-        logger.error(f"Create folder error: {e}")
+        logger.error("Create folder error: %s", e)
         return False
 
-async def upload_file(server_id, path, filename, content, active_sessions):
-    """Upload file to server"""
-    try:
-        if server_id not in active_sessions:
-            return False
+def sftp_store(ssh, local_file, remote_path):
+    """Write an open local file to the server over SFTP"""
+    with sftp_session(ssh) as sftp:
+        sftp.putfo(local_file, remote_path)
+
+def sftp_fetch(ssh, remote_path):
+    """Copy a remote file into a temporary file over SFTP, returns (file, error)"""
+    with sftp_session(ssh) as sftp:
+        # Check file size before transferring anything (Telegram limit)
+        file_size = sftp.stat(remote_path).st_size
+        if file_size > MAX_FILE_SIZE:
+            return None, f"File too large for Telegram (>{MAX_FILE_SIZE // (1024 * 1024)}MB)"
         
-        ssh = active_sessions[server_id]
-        sftp = ssh.open_sftp()
+        # Pipeline reads with prefetch and stream them to disk
+        local_file = tempfile.TemporaryFile()
+        try:
+            with sftp.open(remote_path, 'rb') as remote_file:
+                remote_file.prefetch(file_size)
+                shutil.copyfileobj(remote_file, local_file, DOWNLOAD_CHUNK_SIZE)
+        except Exception:
+            local_file.close()
+            raise
         
-        remote_path = os.path.join(path, filename).replace('\\', '/')
+        local_file.seek(0)
+        return local_file, None
+
+async def upload_file(server_id, path, filename, local_file, active_sessions):
+    """Upload an open local file to the server"""
+    try:
+        ssh = await acquire_session(server_id)
+        if ssh is None:
+            logger.debug("No active SSH session for server %s", server_id)
+            return False
+        remote_path = posixpath.join(path, filename)
         
-        with tempfile.NamedTemporaryFile() as temp_file:
-            temp_file.write(content)
-            temp_file.flush()
-            sftp.put(temp_file.name, remote_path)
+        await run_blocking(sftp_store, ssh, local_file, remote_path)
+        invalidate_listing(server_id, path)
         
-        sftp.close()
         return True
         
     except Exception as e:
-        logger.error(f"Upload file error: {e}")
+        logger.error("Upload file error: %s", e)
         return False
 
 async def download_file_from_server(server_id, path, filename, active_sessions):
-    """Download file from server"""
+    """Download file from server into a temporary file, returns (file, error)"""
     try:
-        if server_id not in active_sessions:
-            return None
+        ssh = await acquire_session(server_id)
+        if ssh is None:
+            logger.debug("No active SSH session for server %s", server_id)
+            return None, "Failed to download file"
         
-        ssh = active_sessions[server_id]
-        sftp = ssh.open_sftp()
+        remote_path = posixpath.join(path, filename)
         
-        remote_path = os.path.join(path, filename).replace('\\', '/')
-        
-        with tempfile.NamedTemporaryFile() as temp_file:
-            sftp.get(remote_path, temp_file.name)
-            temp_file.seek(0)
-            content = temp_file.read()
-        
-        sftp.close()
-        return content
+        # paramiko is blocking, keep it off the event loop
+        return await run_blocking(sftp_fetch, ssh, remote_path)
         
     except Exception as e:
-        logger.error(f"Download file error: {e}")
-        return None
+        logger.error("Download file error: %s", e)
+        return None, "Failed to download file"
 
 async def rename_item(server_id, path, old_name, new_name, active_sessions):
     """Rename file or folder"""
     try:
-        if server_id not in active_sessions:
+        ssh = await acquire_session(server_id)
+        if ssh is None:
+            logger.debug("No active SSH session for server %s", server_id)
             return False
+        old_path = posixpath.join(path, old_name)
+        new_path = posixpath.join(path, new_name)
         
-        ssh = active_sessions[server_id]
-        old_path = os.path.join(path, old_name).replace('\\', '/')
-        new_path = os.path.join(path, new_name).replace('\\', '/')
-        
-        command = f"mv '{old_path}' '{new_path}'"
-        stdin, stdout, stderr = ssh.exec_command(command)
-        error = stderr.read().decode().strip()
+        command = f"mv -- {shlex.quote(old_path)} {shlex.quote(new_path)}"
+        _, error = await run_blocking(execute_ssh_command, ssh, command)
+        error = error.strip()
+        invalidate_listing(server_id, path)
         
         return not error
         
     except Exception as e:
-        logger.error(f"Rename item error: {e}")
+        logger.error("Rename item error: %s", e)
         return False
 
 async def delete_files_on_server(server_id, path, filenames, active_sessions):
     """Delete files on server"""
     try:
-        if server_id not in active_sessions:
+        ssh = await acquire_session(server_id)
+        if ssh is None:
+            logger.debug("No active SSH session for server %s", server_id)
             return False
         
-        ssh = active_sessions[server_id]
+        # Remove everything in one round-trip
+        file_paths = [posixpath.join(path, filename) for filename in filenames]
+        command = "rm -rf -- " + ' '.join(shlex.quote(p) for p in file_paths)
+        _, error = await run_blocking(execute_ssh_command, ssh, command)
+        error = error.strip()
         
-        for filename in filenames:
-            file_path = os.path.join(path, filename).replace('\\', '/')
-            command = f"rm -rf '{file_path}'"
-            stdin, stdout, stderr = ssh.exec_command(command)
-            error = stderr.read().decode().strip()
-            
-            if error:
-                logger.error(f"Delete error for {filename}: {error}")
-                return False
+        if error:
+            invalidate_listing(server_id, path)
+            # rm keeps going past failures and names each one on stderr, attribute them per file
+            failed_paths = {
+                line.split("cannot remove '", 1)[1].rsplit("': ", 1)[0]
+                for line in error.splitlines() if "cannot remove '" in line
+            }
+            # Exact matches only, '/srv/a' must not be blamed for '/srv/ab'
+            failed = [name for name, p in zip(filenames, file_paths) if p in failed_paths]
+            logger.warning("Delete error in %s for %s: %s", path, failed or filenames, error)
+            return False
+        
+        # Everything is gone, so the cached listing can be fixed up without listing again
+        prune_listing(server_id, path, filenames)
         
         return True
         
     except Exception as e:
-        logger.error(f"Delete files error: {e}")
+        logger.error("Delete files error: %s", e)
         return False
 
 async def create_zip_on_server(server_id, path, filenames, zip_name, active_sessions):
     """Create zip archive on server"""
     try:
-        if server_id not in active_sessions:
+        ssh = await acquire_session(server_id)
+        if ssh is None:
+            logger.debug("No active SSH session for server %s", server_id)
             return False
         
-        ssh = active_sessions[server_id]
-        
-        # Check if zip is installed
-        stdin, stdout, stderr = ssh.exec_command("which zip")
-        if not stdout.read().decode().strip():
-            # Try with tar if zip is not available
-            files_str = ' '.join([f"'{f}'" for f in filenames])
-            tar_name = zip_name.replace('.zip', '.tar.gz')
-            command = f"cd '{path}' && tar -czf '{tar_name}' {files_str}"
-        else:
-            # Use zip
-            files_str = ' '.join([f"'{f}'" for f in filenames])
-            command = f"cd '{path}' && zip -r '{zip_name}' {files_str}"
+        # Fall back to tar when zip is not installed, decided by the remote shell;
+        # archivers run quietly so a large tree can't hit the output cap and cut the job short
+        files_str = ' '.join(shlex.quote(f) for f in filenames)
+        tar_name = zip_name.replace('.zip', '.tar.gz')
+        command = (
+            f"cd {shlex.quote(path)} && if command -v zip >/dev/null 2>&1; "
+            f"then zip -q -r {shlex.quote(zip_name)} -- {files_str}; "
+            f"else tar -czf {shlex.quote(tar_name)} -- {files_str}; fi > /dev/null"
+        )
         
-        stdin, stdout, stderr = ssh.exec_command(command)
-        stdout_output = stdout.read().decode()
-        error = stderr.read().decode().strip()
+        _, error = await run_blocking(execute_ssh_command, ssh, command)
+        error = error.strip()
+        invalidate_listing(server_id, path)
         
-        # Check if command succeeded
-        if not error or "adding:" in stdout_output or "deflated" in stdout_output:
+        # The exit status decides, execute_ssh_command reports any non-zero one as an error
+        if not error:
             return True
         
-        logger.error(f"Zip creation error: {error}")
+        logger.warning("Zip creation error: %s", error)
         return False
         
     except Exception as e:
-        logger.error(f"Create zip error: {e}")
+        logger.error("Create zip error: %s", e)
         return False
 
 async def extract_archive_on_server(server_id, path, archive_filename, active_sessions):
     """Extract archive on server"""
     try:
-        if server_id not in active_sessions:
+        ssh = await acquire_session(server_id)
+        if ssh is None:
+            logger.debug("No active SSH session for server %s", server_id)
             return False
         
-        ssh = active_sessions[server_id]
-        
-        archive_path = os.path.join(path, archive_filename).replace('\\', '/')
+        archive_path = posixpath.join(path, archive_filename)
         
         # Create extraction directory
-        extract_dir = os.path.splitext(archive_filename)[0]
+        extract_dir = posixpath.splitext(archive_filename)[0]
         if extract_dir.endswith('.tar'):
-            extract_dir = os.path.splitext(extract_dir)[0]
+            extract_dir = posixpath.splitext(extract_dir)[0]
         
-        extract_path = os.path.join(path, extract_dir).replace('\\', '/')
+        extract_path = posixpath.join(path, extract_dir)
         
-        # Create extraction directory
-        stdin, stdout, stderr = ssh.exec_command(f"mkdir -p '{extract_path}'")
-        
-        # Determine archive type and extract
-        if archive_filename.lower().endswith('.zip'):
-            # Check if unzip is available
-            stdin, stdout, stderr = ssh.exec_command("which unzip")
-            if stdout.read().decode().strip():
-                command = f"cd '{extract_path}' && unzip '{archive_path}'"
-            else:
-                return False
-                
-        elif archive_filename.lower().endswith(('.tar.gz', '.tgz')):
-            command = f"cd '{extract_path}' && tar -xzf '{archive_path}'"
-            
-        elif archive_filename.lower().endswith(('.tar.bz2', '.tbz2')):
-            command = f"cd '{extract_path}' && tar -xjf '{archive_path}'"
-            
-        elif archive_filename.lower().endswith(('.tar.xz', '.txz')):
-            command = f"cd '{extract_path}' && tar -xJf '{archive_path}'"
-            
-        elif archive_filename.lower().endswith('.tar'):
-            command = f"cd '{extract_path}' && tar -xf '{archive_path}'"
-            
-        elif archive_filename.lower().endswith('.rar'):
-            # Check if unrar is available
-            stdin, stdout, stderr = ssh.exec_command("which unrar")
-            if stdout.read().decode().strip():
-                command = f"cd '{extract_path}' && unrar x '{archive_path}'"
-            else:
-                return False
-                
-        elif archive_filename.lower().endswith('.7z'):
-            # Check if 7z is available
-            stdin, stdout, stderr = ssh.exec_command("which 7z")
-            if stdout.read().decode().strip():
-                command = f"cd '{extract_path}' && 7z x '{archive_path}'"
-            else:
-                return False
+        quoted_archive = shlex.quote(archive_path)
+        
+        # Determine archive type; a missing extractor shows up as "command not found" on stderr
+        lower_name = archive_filename.lower()
+        if lower_name.endswith('.zip'):
+            extract_command = f"unzip -q -- {quoted_archive}"
+        elif lower_name.endswith(('.tar.gz', '.tgz')):
+            extract_command = f"tar -xzf {quoted_archive}"
+        elif lower_name.endswith(('.tar.bz2', '.tbz2')):
+            extract_command = f"tar -xjf {quoted_archive}"
+        elif lower_name.endswith(('.tar.xz', '.txz')):
+            extract_command = f"tar -xJf {quoted_archive}"
+        elif lower_name.endswith('.tar'):
+            extract_command = f"tar -xf {quoted_archive}"
+        elif lower_name.endswith('.rar'):
+            extract_command = f"unrar x -- {quoted_archive}"
+        elif lower_name.endswith('.7z'):
+            extract_command = f"7z x -- {quoted_archive}"
         else:
             return False
         
-        stdin, stdout, stderr = ssh.exec_command(command)
-        stdout_output = stdout.read().decode()
-        error = stderr.read().decode().strip()
+        # Create the extraction directory and extract in one round-trip, discarding the file-by-file listing
+        quoted_extract = shlex.quote(extract_path)
+        command = f"mkdir -p -- {quoted_extract} && cd {quoted_extract} && {extract_command} > /dev/null"
         
-        # Check if extraction succeeded
-        if not error or "inflating:" in stdout_output or "extracting:" in stdout_output or "x " in stdout_output:
+        _, error = await run_blocking(execute_ssh_command, ssh, command)
+        error = error.strip()
+        invalidate_listing(server_id, path)
+        
+        # The exit status decides, execute_ssh_command reports any non-zero one as an error
+        if not error:
             return True
         
-        logger.error(f"Extract error: {error}")
+        logger.warning("Extract error: %s", error)
         return False
         
     except Exception as e:
-        logger.error(f"Extract archive error: {e}")
+        logger.error("Extract archive error: %s", e)
         return False
 
 async def copy_files_on_server(server_id, source_path, filenames, dest_path, active_sessions):
     """Copy files on server"""
     try:
-        if server_id not in active_sessions:
+        ssh = await acquire_session(server_id)
+        if ssh is None:
+            logger.debug("No active SSH session for server %s", server_id)
             return False
         
-        ssh = active_sessions[server_id]
-        
-        # Create destination directory if it doesn't exist
-        command = f"mkdir -p '{dest_path}'"
-        stdin, stdout, stderr = ssh.exec_command(command)
+        # Create the destination and copy all files in one round-trip
+        source_files = [posixpath.join(source_path, filename) for filename in filenames]
+        quoted_dest = shlex.quote(dest_path)
+        command = (
+            f"mkdir -p {quoted_dest} && "
+            f"cp -r -t {quoted_dest} -- " + ' '.join(shlex.quote(f) for f in source_files)
+        )
+        _, error = await run_blocking(execute_ssh_command, ssh, command)
+        error = error.strip()
+        invalidate_listing(server_id, dest_path)
         
-        # Copy each file
-        for filename in filenames:
-            source_file = os.path.join(source_path, filename).replace('\\', '/')
-            dest_file = os.path.join(dest_path, filename).replace('\\', '/')
-            
-            command = f"cp -r '{source_file}' '{dest_file}'"
-            stdin, stdout, stderr = ssh.exec_command(command)
-            error = stderr.read().decode().strip()
-            
-            if error:
-                logger.error(f"Copy error for {filename}: {error}")
-                return False
+        if error:
+            logger.warning("Copy error to %s: %s", dest_path, error)
+            return False
         
         return True
         
     except Exception as e:
-        logger.error(f"Copy files error: {e}")
+        logger.error("Copy files error: %s", e)
         return False
 
 async def move_files_on_server(server_id, source_path, filenames, dest_path, active_sessions):
     """Move files on server"""
     try:
-        if server_id not in active_sessions:
+        ssh = await acquire_session(server_id)
+        if ssh is None:
+            logger.debug("No active SSH session for server %s", server_id)
             return False
         
-        ssh = active_sessions[server_id]
+        # Create the destination and move all files in one round-trip
+        source_files = [posixpath.join(source_path, filename) for filename in filenames]
+        quoted_dest = shlex.quote(dest_path)
+        command = (
+            f"mkdir -p {quoted_dest} && "
+            f"mv -t {quoted_dest} -- " + ' '.join(shlex.quote(f) for f in source_files)
+        )
+        _, error = await run_blocking(execute_ssh_command, ssh, command)
+        error = error.strip()
+        invalidate_listing(server_id, source_path, dest_path)
         
-        # Create destination directory if it doesn't exist
-        command = f"mkdir -p '{dest_path}'"
-        stdin, stdout, stderr = ssh.exec_command(command)
-        
-        # Move each file
-        for filename in filenames:
-            source_file = os.path.join(source_path, filename).replace('\\', '/')
-            dest_file = os.path.join(dest_path, filename).replace('\\', '/')
-            
-            command = f"mv '{source_file}' '{dest_file}'"
-            stdin, stdout, stderr = ssh.exec_command(command)
-            error = stderr.read().decode().strip()
-            
-            if error:
-                logger.error(f"Move error for {filename}: {error}")
-                return False
+        if error:
+            logger.warning("Move error to %s: %s", dest_path, error)
+            return False
         
         return True
         
     except Exception as e:
-        logger.error(f"Move files error: {e}")
+        logger.error("Move files error: %s", e)
         return False
@@ -1,37 +1,50 @@
 import logging
+import asyncio
 import io
+import re
+from functools import lru_cache
 import paramiko
 from aiogram import Bot, Dispatcher, types
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, BotCommand # <-- Added BotCommand
 from aiogram.utils import executor
 from aiogram.utils.exceptions import MessageNotModified
-from config import BOT_TOKEN
+from config import BOT_TOKEN, BOT_CONNECTIONS_LIMIT, BOT_API_TIMEOUT
 from db import (
     add_server,
     get_servers,
-    get_server_by_id,
     update_server_name,
     update_server_username,
     delete_server_by_id
 )
 from bson.objectid import ObjectId
 from bson.errors import InvalidId
-from file_manager import init_file_manager
+from ssh_manager import active_sessions, get_ssh_session, close_ssh_session, reap_dead_sessions, run_blocking
+from file_manager import init_file_manager, UserInput, get_server_cached, escape_html, invalidate_server, keep_sessions_warm, prune_server_cache, prune_idle_users
 from bot_manager import init_bot_manager
 from datetime import datetime
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-bot = Bot(token=BOT_TOKEN)
+# Idle percentage in the "Cpu(s)" line of top
+CPU_IDLE_RE = re.compile(r'(\d+\.?\d*)%?\s*id')
+
+bot = Bot(token=BOT_TOKEN, connections_limit=BOT_CONNECTIONS_LIMIT, timeout=BOT_API_TIMEOUT)
 dp = Dispatcher(bot)
 
 # --- UTILS ---
 
+@lru_cache(maxsize=1)
 def cancel_button():
     """Create cancel button"""
     return InlineKeyboardMarkup().add(InlineKeyboardButton("❌ Cancel", callback_data="cancel"))
 
+@lru_cache(maxsize=1)
+def first_server_button():
+    """Create add-first-server button"""
+    return InlineKeyboardMarkup().add(InlineKeyboardButton("➕ Add Your First Server", callback_data="add_server"))
+
+@lru_cache(maxsize=2048)
 def back_button(to):
     """Create back button"""
     return InlineKeyboardMarkup().add(InlineKeyboardButton("⬅️ Back", callback_data=to))
@@ -55,86 +68,27 @@ def format_uptime(seconds):
     
     return ", ".join(parts) or "Less than a minute"
 
+SIZE_UNITS = ('B', 'KB', 'MB', 'GB', 'TB')
+
 def format_size(size_str):
     """Format file size for better display"""
     try:
-        size = float(size_str)
-        for unit in ['B', 'KB', 'MB', 'GB']:
-            if size < 1024.0:
-                return f"{size:.1f} {unit}"
-            size /= 1024.0
-        return f"{size:.1f} TB"
-    except:
+        size = int(float(size_str))
+    except (TypeError, ValueError):
         return size_str
-
-# --- GLOBAL STATE ---
-user_input = {}
-active_sessions = {}  # Store SSH sessions: {server_id: SSHClient}
-
-# --- SSH SESSION MANAGEMENT ---
-
-def get_ssh_session(server_id, ip, username, key_content):
-    """Get or create SSH session"""
-    logger.info(f"Getting SSH session for server {server_id} ({ip})")
     
-    try:
-        # Check if existing session is still active
-        if server_id in active_sessions:
-            try:
-                transport = active_sessions[server_id].get_transport()
-                if transport and transport.is_active():
-                    logger.info(f"Reusing existing SSH session for {server_id}")
-                    return active_sessions[server_id]
-                else:
-                    # Clean up dead session
-                    logger.info(f"Cleaning up dead SSH session for {server_id}")
-                    active_sessions.pop(server_id, None)
-            except:
-                active_sessions.pop(server_id, None)
-        
-        # Create new session
-        key_file = io.StringIO(key_content)
-        ssh_key = None
-        
-        # Try different key types
-        for key_class in [paramiko.RSAKey, paramiko.ECDSAKey, paramiko.Ed25519Key, paramiko.DSSKey]:
-            try:
-                key_file.seek(0)
-                ssh_key = key_class.from_private_key(key_file)
-                break
-            except paramiko.SSHException:
-                continue
-        
-        if not ssh_key:
-            raise paramiko.SSHException("Unsupported or invalid key format")
-        
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(ip, username=username, pkey=ssh_key, timeout=15)
-        
-        active_sessions[server_id] = ssh
-        logger.info(f"Created new SSH session for {server_id}")
-        return ssh
-        
-    except Exception as e:
-        logger.error(f"Failed to create SSH session for {ip}: {e}")
-        raise
+    # Each unit is 2**10 of the previous one, so the bit length picks it directly
+    unit = min(max(size.bit_length() - 1, 0) // 10, len(SIZE_UNITS) - 1)
+    return f"{size / (1 << (10 * unit)):.1f} {SIZE_UNITS[unit]}"
 
-def close_ssh_session(server_id):
-    """Close SSH session"""
-    if server_id in active_sessions:
-        try:
-            active_sessions[server_id].close()
-        except:
-            pass
-        active_sessions.pop(server_id, None)
-        logger.info(f"Closed SSH session for {server_id}")
+# --- GLOBAL STATE ---
+user_input = {}  # Pending prompt per user: {user_id: UserInput}
 
 # --- SERVER STATS ---
 
 def get_remote_stats(server_id, ip, username, key_content):
     """Fetch remote server statistics"""
-    logger.info(f"Fetching stats for {ip} with user {username}")
+    logger.info("Fetching stats for %s with user %s", ip, username)
     
     try:
         ssh = get_ssh_session(server_id, ip, username, key_content)
@@ -159,7 +113,7 @@ def get_remote_stats(server_id, ip, username, key_content):
             stats['os'] = f"{distro}, Kernel {kernel}"
             
         except Exception as e:
-            logger.error(f"OS info error: {e}")
+            logger.error("OS info error: %s", e)
             stats['os'] = "Unknown"
         
         # Uptime
@@ -174,7 +128,7 @@ def get_remote_stats(server_id, ip, username, key_content):
                 stats['uptime'] = "Unknown"
                 
         except Exception as e:
-            logger.error(f"Uptime error: {e}")
+            logger.error("Uptime error: %s", e)
             stats['uptime'] = "Unknown"
         
         # Memory
@@ -190,7 +144,7 @@ def get_remote_stats(server_id, ip, username, key_content):
                 stats['ram_total'] = stats['ram_used'] = "Unknown"
                 
         except Exception as e:
-            logger.error(f"Memory error: {e}")
+            logger.error("Memory error: %s", e)
             stats['ram_total'] = stats['ram_used'] = "Unknown"
         
         # Disk
@@ -206,7 +160,7 @@ def get_remote_stats(server_id, ip, username, key_content):
                 stats['disk_total'] = stats['disk_used'] = "Unknown"
                 
         except Exception as e:
-            logger.error(f"Disk error: {e}")
+            logger.error("Disk error: %s", e)
             stats['disk_total'] = stats['disk_used'] = "Unknown"
         
         # CPU Usage
@@ -216,8 +170,7 @@ def get_remote_stats(server_id, ip, username, key_content):
             
             if cpu_line:
                 # Parse CPU usage from top output
-                import re
-                idle_match = re.search(r'(\d+\.?\d*)%?\s*id', cpu_line)
+                idle_match = CPU_IDLE_RE.search(cpu_line)
                 if idle_match:
                     cpu_idle = float(idle_match.group(1))
                     stats['cpu_usage'] = round(100 - cpu_idle, 2)
@@ -227,13 +180,13 @@ def get_remote_stats(server_id, ip, username, key_content):
                 stats['cpu_usage'] = "Unknown"
                 
         except Exception as e:
-            logger.error(f"CPU error: {e}")
+            logger.error("CPU error: %s", e)
             stats['cpu_usage'] = "Unknown"
         
         return stats
         
     except Exception as e:
-        logger.error(f"SSH error for {ip}: {e}")
+        logger.error("SSH error for %s: %s", ip, e)
         return {"error": str(e)}
 
 # --- STARTUP HOOK ---
@@ -254,29 +207,47 @@ async def on_startup(_):
         await bot.set_my_commands(commands)
         logger.info("✅ Telegram Bot Command Menu set.")
     except Exception as e:
-        logger.error(f"Failed to set bot commands: {e}")
+        logger.error("Failed to set bot commands: %s", e)
 
     try:
         servers = await get_servers()
-        logger.info(f"Found {len(servers)} servers in database")
+        logger.info("Found %s servers in database", len(servers))
         
-        # Pre-connect to all servers
-        for server in servers:
+        # Pre-connect to all servers concurrently
+        async def preconnect(server):
             server_id = str(server['_id'])
             try:
-                get_ssh_session(server_id, server['ip'], server['username'], server['key_content'])
-                logger.info(f"✅ Connected to {server['name']} ({server['ip']})")
+                await run_blocking(get_ssh_session, server_id, server['ip'], server['username'], server['key_content'])
+                logger.info("✅ Connected to %s (%s)", server['name'], server['ip'])
             except Exception as e:
-                logger.error(f"❌ Failed to connect to {server['name']} ({server['ip']}): {e}")
+                logger.error("❌ Failed to connect to %s (%s): %s", server['name'], server['ip'], e)
+        
+        await asyncio.gather(*(preconnect(server) for server in servers))
     
     except Exception as e:
-        logger.error(f"Startup error: {e}")
+        logger.error("Startup error: %s", e)
+    
+    # Drop sessions that die while the bot is idle, and bring back the ones file managers still use
+    asyncio.create_task(reap_dead_sessions())
+    asyncio.create_task(keep_sessions_warm())
+    asyncio.create_task(prune_server_cache())
+    asyncio.create_task(prune_idle_users(user_input))
     
     # Initialize all modules
     init_file_manager(dp, bot, active_sessions, user_input)
     init_bot_manager(dp, bot, active_sessions, user_input)
     logger.info("✅ Bot startup complete")
 
+async def on_shutdown(_):
+    """Close SSH sessions and the Bot API connection pool"""
+    for server_id in list(active_sessions):
+        close_ssh_session(server_id)
+    
+    # aiogram keeps one aiohttp session for all API calls; close it so sockets shut down cleanly
+    session = await bot.get_session()
+    await session.close()
+    logger.info("👋 Bot shutdown complete")
+
 # --- MAIN HANDLERS ---
 
 @dp.message_handler(commands=['start'])
@@ -286,16 +257,13 @@ async def start_command(message: types.Message):
         servers = await get_servers()
         
         if not servers:
-            kb = InlineKeyboardMarkup()
             # Note: The 'add_server' command is also handled by a message_handler below
-            kb.add(InlineKeyboardButton("➕ Add Your First Server", callback_data="add_server")) 
-            
             await message.answer(
                 "🔧 <b>Multi Server Manager</b>\n\n"
                 "Welcome! You don't have any servers configured yet.\n"
                 "Add your first server to get started.",
                 parse_mode='HTML',
-                reply_markup=kb
+                reply_markup=first_server_button()
             )
             return
         
@@ -321,7 +289,7 @@ async def start_command(message: types.Message):
         )
         
     except Exception as e:
-        logger.error(f"Start command error: {e}")
+        logger.error("Start command error: %s", e)
         await message.answer("❌ Error loading servers. Please try again.")
 
 # --- ADDED HANDLER TO CATCH /add_server command directly ---
@@ -333,7 +301,6 @@ async def add_server_command(message: types.Message):
 # ------------------------------------------------------------
 
 
-@dp.callback_query_handler(lambda c: c.data == "start")
 async def back_to_start(callback: types.CallbackQuery):
     """Return to main menu"""
     try:
@@ -345,12 +312,11 @@ async def back_to_start(callback: types.CallbackQuery):
         await start_command(callback.message)
         
     except Exception as e:
-        logger.error(f"Back to start error: {e}")
+        logger.error("Back to start error: %s", e)
         await callback.message.edit_text("❌ Error returning to main menu.")
 
 # --- HANDLER FOR /cancel command AND cancel callback ---
 @dp.message_handler(commands=['cancel'])
-@dp.callback_query_handler(lambda c: c.data == "cancel")
 async def cancel_action(input_obj: types.Message | types.CallbackQuery):
     """Cancel current action"""
     
@@ -372,7 +338,6 @@ async def cancel_action(input_obj: types.Message | types.CallbackQuery):
 
 # --- SERVER MANAGEMENT (START ADDING SERVER) ---
 
-@dp.callback_query_handler(lambda c: c.data == "add_server")
 async def add_server_start(callback: types.CallbackQuery | types.Message):
     """Start adding a new server (Handles both callback and direct command)"""
     
@@ -382,7 +347,7 @@ async def add_server_start(callback: types.CallbackQuery | types.Message):
     if isinstance(callback, types.CallbackQuery):
         await callback.answer()
 
-    user_input[user_id] = {'step': 'name'}
+    user_input[user_id] = UserInput(step='name')
     
     await bot.send_message(
         user_id,
@@ -391,20 +356,21 @@ async def add_server_start(callback: types.CallbackQuery | types.Message):
         reply_markup=cancel_button()
     )
 
-@dp.message_handler(lambda message: message.from_user.id in user_input and user_input[message.from_user.id].get('step'))
+@dp.message_handler(lambda message: getattr(user_input.get(message.from_user.id), 'step', None))
 async def handle_server_inputs(message: types.Message):
     """Handle server configuration inputs"""
     uid = message.from_user.id
-    if uid not in user_input or 'step' not in user_input[uid]:
+    pending = user_input.get(uid)
+    if pending is None or not pending.step:
         return
     
-    step = user_input[uid]['step']
-    logger.info(f"Handling server input for user {uid}, step: {step}")
+    step = pending.step
+    logger.info("Handling server input for user %s, step: %s", uid, step)
     
     try:
         if step == 'name':
-            user_input[uid]['name'] = message.text.strip()
-            user_input[uid]['step'] = 'username'
+            pending.name = message.text.strip()
+            pending.step = 'username'
             await message.answer(
                 "👤 <b>Server Username</b>\n\nEnter SSH username:",
                 parse_mode='HTML',
@@ -412,8 +378,8 @@ async def handle_server_inputs(message: types.Message):
             )
             
         elif step == 'username':
-            user_input[uid]['username'] = message.text.strip()
-            user_input[uid]['step'] = 'ip'
+            pending.username = message.text.strip()
+            pending.step = 'ip'
             await message.answer(
                 "🌐 <b>Server IP Address</b>\n\nEnter IP address or hostname:",
                 parse_mode='HTML',
@@ -421,8 +387,8 @@ async def handle_server_inputs(message: types.Message):
             )
             
         elif step == 'ip':
-            user_input[uid]['ip'] = message.text.strip()
-            user_input[uid]['step'] = 'key'
+            pending.ip = message.text.strip()
+            pending.step = 'key'
             await message.answer(
                 "🔑 <b>SSH Private Key</b>\n\nSend your SSH private key file:",
                 parse_mode='HTML',
@@ -430,7 +396,7 @@ async def handle_server_inputs(message: types.Message):
             )
             
     except Exception as e:
-        logger.error(f"Server input error: {e}")
+        logger.error("Server input error: %s", e)
         await message.answer("❌ Error processing input. Please try again.")
 
 @dp.message_handler(content_types=types.ContentType.DOCUMENT)
@@ -439,7 +405,8 @@ async def handle_key_upload(message: types.Message):
     uid = message.from_user.id
     
     # Check if this is for server setup
-    if uid not in user_input or user_input[uid].get('step') != 'key':
+    data = user_input.get(uid)
+    if data is None or data.step != 'key':
         return
     
     try:
@@ -449,9 +416,6 @@ async def handle_key_upload(message: types.Message):
         file = await bot.download_file_by_id(message.document.file_id)
         key_content = file.read().decode('utf-8')
         
-        data = user_input[uid]
-        data['key_content'] = key_content
-        
         await message.answer("🔌 Testing connection...")
         
         # Test SSH connection
@@ -474,11 +438,11 @@ async def handle_key_upload(message: types.Message):
             if not ssh_key:
                 raise ValueError("Invalid or unsupported key format")
             
-            ssh.connect(data['ip'], username=data['username'], pkey=ssh_key, timeout=15)
+            ssh.connect(data.ip, username=data.username, pkey=ssh_key, timeout=15)
             ssh.close()
             
             # Save server to database
-            await add_server(data)
+            await add_server({'name': data.name, 'username': data.username, 'ip': data.ip, 'key_content': key_content})
             
             # Get the new server ID and establish session
             servers = await get_servers()
@@ -486,21 +450,21 @@ async def handle_key_upload(message: types.Message):
             server_id = str(new_server['_id'])
             
             try:
-                get_ssh_session(server_id, data['ip'], data['username'], key_content)
+                await run_blocking(get_ssh_session, server_id, data.ip, data.username, key_content)
             except Exception as e:
-                logger.error(f"Failed to establish session for new server {server_id}: {e}")
+                logger.error("Failed to establish session for new server %s: %s", server_id, e)
             
             await message.answer(
                 f"✅ <b>Server Added Successfully!</b>\n\n"
-                f"📝 Name: {data['name']}\n"
-                f"👤 Username: {data['username']}\n"
-                f"🌐 IP: {data['ip']}\n\n"
+                f"📝 Name: {data.name}\n"
+                f"👤 Username: {data.username}\n"
+                f"🌐 IP: {data.ip}\n\n"
                 f"Connection test passed!",
                 parse_mode='HTML'
             )
             
         except Exception as e:
-            logger.error(f"SSH connection test failed: {e}")
+            logger.error("SSH connection test failed: %s", e)
             await message.answer(
                 f"❌ <b>Connection Failed</b>\n\n"
                 f"Error: {str(e)}\n\n"
@@ -512,23 +476,22 @@ async def handle_key_upload(message: types.Message):
         await start_command(message)
         
     except Exception as e:
-        logger.error(f"Key upload error: {e}")
+        logger.error("Key upload error: %s", e)
         await message.answer("❌ Error processing key file. Please try again.")
 
 # --- SERVER MENU ---
 
-@dp.callback_query_handler(lambda c: c.data.startswith("server_"))
 async def view_server(callback: types.CallbackQuery):
     """Show server management menu"""
     try:
         server_id = callback.data.split('_')[1]
-        server = await get_server_by_id(server_id)
+        server = await get_server_cached(server_id)
         
         if not server:
             await callback.message.edit_text("❌ Server not found.")
             return
         
-        logger.info(f"Viewing server {server_id}: {server['name']}")
+        logger.info("Viewing server %s: %s", server_id, server['name'])
         
         # Check connection status
         status_icon = "🟢" if server_id in active_sessions else "🔴"
@@ -561,17 +524,16 @@ async def view_server(callback: types.CallbackQuery):
             pass
         
     except Exception as e:
-        logger.error(f"View server error: {e}")
+        logger.error("View server error: %s", e)
         await callback.message.edit_text("❌ Error loading server details.")
 
 # --- SERVER INFO ---
 
-@dp.callback_query_handler(lambda c: c.data.startswith("info_"))
 async def server_info(callback: types.CallbackQuery):
     """Show detailed server information"""
     try:
         server_id = callback.data.split('_')[1]
-        server = await get_server_by_id(server_id)
+        server = await get_server_cached(server_id)
         
         if not server:
             await callback.message.edit_text("❌ Server not found.")
@@ -579,7 +541,7 @@ async def server_info(callback: types.CallbackQuery):
         
         await callback.message.edit_text("📊 <b>Fetching server statistics...</b>", parse_mode="HTML")
         
-        stats = get_remote_stats(server_id, server['ip'], server['username'], server['key_content'])
+        stats = await run_blocking(get_remote_stats, server_id, server['ip'], server['username'], server['key_content'])
         
         if stats.get('error'):
             text = (
@@ -587,7 +549,7 @@ async def server_info(callback: types.CallbackQuery):
                 f"👤 Username: <code>{server['username']}</code>\n"
                 f"🌐 IP Address: <code>{server['ip']}</code>\n\n"
                 f"❌ <b>Error fetching statistics:</b>\n"
-                f"<code>{stats['error']}</code>"
+                f"<code>{escape_html(stats['error'])}</code>"
             )
         else:
             # Format memory usage
@@ -620,17 +582,16 @@ async def server_info(callback: types.CallbackQuery):
             pass
         
     except Exception as e:
-        logger.error(f"Server info error: {e}")
+        logger.error("Server info error: %s", e)
         await callback.message.edit_text("❌ Error fetching server information.")
 
 # --- SERVER SETTINGS ---
 
-@dp.callback_query_handler(lambda c: c.data.startswith("edit_"))
 async def edit_server(callback: types.CallbackQuery):
     """Show server settings menu"""
     try:
         server_id = callback.data.split('_')[1]
-        server = await get_server_by_id(server_id)
+        server = await get_server_cached(server_id)
         
         if not server:
             await callback.message.edit_text("❌ Server not found.")
@@ -659,17 +620,16 @@ async def edit_server(callback: types.CallbackQuery):
             pass
         
     except Exception as e:
-        logger.error(f"Edit server error: {e}")
+        logger.error("Edit server error: %s", e)
         await callback.message.edit_text("❌ Error loading settings menu.")
 
 # --- RECONNECT SERVER ---
 
-@dp.callback_query_handler(lambda c: c.data.startswith("reconnect_"))
 async def reconnect_server(callback: types.CallbackQuery):
     """Reconnect to server"""
     try:
         server_id = callback.data.split('_')[1]
-        server = await get_server_by_id(server_id)
+        server = await get_server_cached(server_id)
         
         if not server:
             await callback.message.edit_text("❌ Server not found.")
@@ -682,7 +642,7 @@ async def reconnect_server(callback: types.CallbackQuery):
         
         try:
             # Create new session
-            get_ssh_session(server_id, server['ip'], server['username'], server['key_content'])
+            await run_blocking(get_ssh_session, server_id, server['ip'], server['username'], server['key_content'])
             
             # Use try-except to prevent MessageNotModified errors
             try:
@@ -705,17 +665,16 @@ async def reconnect_server(callback: types.CallbackQuery):
             )
             
     except Exception as e:
-        logger.error(f"Reconnect error: {e}")
+        logger.error("Reconnect error: %s", e)
         await callback.message.edit_text("❌ Error during reconnection.")
 
 # --- RENAME SERVER ---
 
-@dp.callback_query_handler(lambda c: c.data.startswith("rename_"))
 async def rename_server(callback: types.CallbackQuery):
     """Start server rename process"""
     try:
         server_id = callback.data.split('_')[1]
-        user_input[callback.from_user.id] = {'edit': 'name', 'id': server_id}
+        user_input[callback.from_user.id] = UserInput(edit='name', server_id=server_id)
         
         await bot.send_message(
             callback.from_user.id,
@@ -725,17 +684,16 @@ async def rename_server(callback: types.CallbackQuery):
         )
         
     except Exception as e:
-        logger.error(f"Rename server error: {e}")
+        logger.error("Rename server error: %s", e)
         await callback.message.edit_text("❌ Error initiating rename.")
 
 # --- CHANGE USERNAME ---
 
-@dp.callback_query_handler(lambda c: c.data.startswith("reuser_"))
 async def change_username(callback: types.CallbackQuery):
     """Start username change process"""
     try:
         server_id = callback.data.split('_')[1]
-        user_input[callback.from_user.id] = {'edit': 'username', 'id': server_id}
+        user_input[callback.from_user.id] = UserInput(edit='username', server_id=server_id)
         
         await bot.send_message(
             callback.from_user.id,
@@ -745,17 +703,16 @@ async def change_username(callback: types.CallbackQuery):
         )
         
     except Exception as e:
-        logger.error(f"Change username error: {e}")
+        logger.error("Change username error: %s", e)
         await callback.message.edit_text("❌ Error initiating username change.")
 
 # --- DELETE SERVER ---
 
-@dp.callback_query_handler(lambda c: c.data.startswith("delete_") and not c.data.startswith("delete_confirm_"))
 async def confirm_delete_server(callback: types.CallbackQuery):
     """Confirm server deletion"""
     try:
         server_id = callback.data.split('_')[1]
-        server = await get_server_by_id(server_id)
+        server = await get_server_cached(server_id)
         
         if not server:
             await callback.message.edit_text("❌ Server not found.")
@@ -781,15 +738,14 @@ async def confirm_delete_server(callback: types.CallbackQuery):
             pass
         
     except Exception as e:
-        logger.error(f"Confirm delete error: {e}")
+        logger.error("Confirm delete error: %s", e)
         await callback.message.edit_text("❌ Error initiating deletion.")
 
-@dp.callback_query_handler(lambda c: c.data.startswith("delete_confirm_"))
 async def delete_server_confirm(callback: types.CallbackQuery):
     """Execute server deletion"""
     try:
         server_id = callback.data.split('_')[2]
-        server = await get_server_by_id(server_id)
+        server = await get_server_cached(server_id)
         
         if not server:
             await callback.message.edit_text("❌ Server not found.")
@@ -800,6 +756,7 @@ async def delete_server_confirm(callback: types.CallbackQuery):
         
         # Delete from database
         await delete_server_by_id(server_id)
+        invalidate_server(server_id)
         
         await callback.message.edit_text(
             f"✅ <b>Server Deleted</b>\n\n"
@@ -811,38 +768,40 @@ async def delete_server_confirm(callback: types.CallbackQuery):
         await start_command(callback.message)
         
     except Exception as e:
-        logger.error(f"Delete server error: {e}")
+        logger.error("Delete server error: %s", e)
         await callback.message.edit_text("❌ Error deleting server.")
 
 # --- HANDLE EDIT INPUTS ---
 
-@dp.message_handler(lambda message: message.from_user.id in user_input and user_input[message.from_user.id].get('edit') in ['name', 'username'])
+@dp.message_handler(lambda message: getattr(user_input.get(message.from_user.id), 'edit', None) in ('name', 'username'))
 async def handle_edit_inputs(message: types.Message):
     """Handle server edit inputs"""
     uid = message.from_user.id
-    if uid not in user_input or 'edit' not in user_input[uid]:
+    data = user_input.get(uid)
+    if data is None or not data.edit:
         return
     
-    data = user_input[uid]
-    server_id = data['id']
-    edit_type = data['edit']
+    server_id = data.server_id
+    edit_type = data.edit
     
-    logger.info(f"Handling {edit_type} edit for server {server_id}")
+    logger.info("Handling %s edit for server %s", edit_type, server_id)
     
     try:
         if edit_type == 'name':
             await update_server_name(server_id, message.text.strip())
+            invalidate_server(server_id)
             await message.answer("✅ <b>Server name updated successfully!</b>", parse_mode='HTML')
             
         elif edit_type == 'username':
             await update_server_username(server_id, message.text.strip())
+            invalidate_server(server_id)
             
             # Reconnect with new username
-            server = await get_server_by_id(server_id)
+            server = await get_server_cached(server_id)
             if server:
                 close_ssh_session(server_id)
                 try:
-                    get_ssh_session(server_id, server['ip'], message.text.strip(), server['key_content'])
+                    await run_blocking(get_ssh_session, server_id, server['ip'], message.text.strip(), server['key_content'])
                     await message.answer("✅ <b>Username updated and reconnected successfully!</b>", parse_mode='HTML')
                 except Exception as e:
                     await message.answer(f"⚠️ <b>Username updated but reconnection failed:</b>\n{str(e)}", parse_mode='HTML')
@@ -850,19 +809,51 @@ async def handle_edit_inputs(message: types.Message):
                 await message.answer("✅ <b>Username updated!</b>", parse_mode='HTML')
         
     except Exception as e:
-        logger.error(f"Error updating {edit_type}: {e}")
+        logger.error("Error updating %s: %s", edit_type, e)
         await message.answer(f"❌ Error updating {edit_type}: {str(e)}")
     
     finally:
         user_input.pop(uid, None)
         await start_command(message)
 
+# --- CALLBACK DISPATCH ---
+
+# Exact callback data, then the word before the first "_", one filter for the whole main menu
+main_callbacks = {
+    'start': back_to_start,
+    'cancel': cancel_action,
+    'add_server': add_server_start,
+}
+main_prefixes = {
+    'server': view_server,
+    'info': server_info,
+    'edit': edit_server,
+    'reconnect': reconnect_server,
+    'rename': rename_server,
+    'reuser': change_username,
+    'delete': confirm_delete_server,
+}
+
+def main_handler(data):
+    """Find the main menu handler for callback data, None if it belongs to another module"""
+    handler = main_callbacks.get(data)
+    if handler is None:
+        prefix, sep, _ = data.partition('_')
+        handler = main_prefixes.get(prefix) if sep else None
+        if handler is confirm_delete_server and data.startswith("delete_confirm_"):
+            handler = delete_server_confirm
+    return handler
+
+@dp.callback_query_handler(lambda c: main_handler(c.data) is not None)
+async def main_dispatch(callback: types.CallbackQuery):
+    await main_handler(callback.data)(callback)
+
 # --- ERROR HANDLERS ---
 
 @dp.errors_handler()
 async def errors_handler(update, exception):
     """Global error handler"""
-    logger.error(f"Update {update} caused error {exception}")
+    logger.error("Update %s caused error %s", update, exception)
     return True
 
 # --- MAIN ---
@@ -872,5 +863,6 @@ if __name__ == '__main__':
     executor.start_polling(
         dp,
         skip_updates=True,
-        on_startup=on_startup
+        on_startup=on_startup,
+        on_shutdown=on_shutdown
     )
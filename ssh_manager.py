@@ -0,0 +1,194 @@
+import logging
+import asyncio
+import io
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache, partial
+import paramiko
+from config import SSH_KEEPALIVE_INTERVAL, SSH_REAP_INTERVAL, SSH_MAX_OUTPUT, SSH_WORKERS, SSH_MAX_CHANNELS
+
+logger = logging.getLogger(__name__)
+
+# --- GLOBAL STATE ---
+active_sessions = {}  # Store SSH sessions: {server_id: SSHClient}
+ssh_executor = ThreadPoolExecutor(max_workers=SSH_WORKERS, thread_name_prefix="ssh")
+channel_slots = weakref.WeakKeyDictionary()  # Concurrent channel limit per connection: {SSHClient: BoundedSemaphore}
+channel_slots_lock = threading.Lock()
+sftp_clients = weakref.WeakKeyDictionary()  # Long-lived SFTP channel per connection: {SSHClient: SFTPClient}
+sftp_locks = weakref.WeakKeyDictionary()  # Serializes use of each shared SFTP channel: {SSHClient: Lock}
+
+# --- SSH SESSION MANAGEMENT ---
+
+def get_live_session(server_id):
+    """Return the stored SSH session if it passes a liveness probe"""
+    ssh = active_sessions.get(server_id)
+    if ssh is None:
+        return None
+    
+    try:
+        transport = ssh.get_transport()
+        if transport and transport.is_active():
+            # Cheap write that fails fast on a half-closed connection
+            transport.send_ignore()
+            return ssh
+    except Exception as e:
+        logger.info("SSH session for %s failed liveness probe: %s", server_id, e)
+    
+    close_ssh_session(server_id)
+    return None
+
+@lru_cache(maxsize=64)
+def load_private_key(key_content):
+    """Parse a private key once, trying each supported key type"""
+    key_file = io.StringIO(key_content)
+    
+    for key_class in [paramiko.RSAKey, paramiko.ECDSAKey, paramiko.Ed25519Key, paramiko.DSSKey]:
+        try:
+            key_file.seek(0)
+            return key_class.from_private_key(key_file)
+        except paramiko.SSHException:
+            continue
+    
+    raise paramiko.SSHException("Unsupported or invalid key format")
+
+def get_ssh_session(server_id, ip, username, key_content):
+    """Get or create SSH session"""
+    logger.info("Getting SSH session for server %s (%s)", server_id, ip)
+    
+    try:
+        # Check if existing session is still active
+        ssh = get_live_session(server_id)
+        if ssh is not None:
+            logger.info("Reusing existing SSH session for %s", server_id)
+            return ssh
+        
+        # Create new session
+        ssh_key = load_private_key(key_content)
+        
+        ssh = paramiko.SSHClient()
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        # Only the stored key is offered, skip agent and ~/.ssh key probing
+        ssh.connect(ip, username=username, pkey=ssh_key, timeout=15, allow_agent=False, look_for_keys=False)
+        ssh.get_transport().set_keepalive(SSH_KEEPALIVE_INTERVAL)
+        
+        active_sessions[server_id] = ssh
+        logger.info("Created new SSH session for %s", server_id)
+        return ssh
+        
+    except Exception as e:
+        logger.error("Failed to create SSH session for %s: %s", ip, e)
+        raise
+
+def close_ssh_session(server_id):
+    """Close SSH session"""
+    if server_id in active_sessions:
+        ssh = active_sessions[server_id]
+        try:
+            ssh.close()
+        except Exception:
+            pass
+        sftp_clients.pop(ssh, None)
+        active_sessions.pop(server_id, None)
+        logger.info("Closed SSH session for %s", server_id)
+
+# --- COMMAND EXECUTION ---
+
+async def run_blocking(func, *args):
+    """Run a blocking paramiko call on the shared SSH worker pool"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(ssh_executor, partial(func, *args))
+
+def read_capped(recv, max_bytes):
+    """Read from a channel stream until EOF or max_bytes, returns (data, truncated)"""
+    data = bytearray()
+    while len(data) < max_bytes:
+        chunk = recv(min(65536, max_bytes - len(data)))
+        if not chunk:
+            return bytes(data), False
+        data += chunk
+    return bytes(data), True
+
+def channel_slot(ssh):
+    """Semaphore bounding concurrent channels on one connection (sshd MaxSessions defaults to 10)"""
+    with channel_slots_lock:
+        slot = channel_slots.get(ssh)
+        if slot is None:
+            slot = channel_slots[ssh] = threading.BoundedSemaphore(SSH_MAX_CHANNELS)
+    return slot
+
+@contextmanager
+def sftp_session(ssh):
+    """Yield the connection's shared SFTP client, or a private one while the shared client is busy"""
+    with channel_slots_lock:
+        lock = sftp_locks.setdefault(ssh, threading.Lock())
+    
+    if lock.acquire(blocking=False):
+        try:
+            sftp = sftp_clients.get(ssh)
+            if sftp is None or sftp.get_channel().closed:
+                sftp = sftp_clients[ssh] = ssh.open_sftp()
+            yield sftp
+        finally:
+            lock.release()
+    else:
+        # Don't queue behind a long transfer, open a channel for this call only
+        with channel_slot(ssh):
+            sftp = ssh.open_sftp()
+            try:
+                yield sftp
+            finally:
+                sftp.close()
+
+def list_directory(ssh, path):
+    """List a directory with SFTP READDIR"""
+    with sftp_session(ssh) as sftp:
+        return sftp.listdir_attr(path)
+
+def run_ssh_command(ssh, command, max_bytes=SSH_MAX_OUTPUT):
+    """Run a command and return (exit_status, stdout, stderr), output capped at max_bytes"""
+    with channel_slot(ssh):
+        channel = ssh.get_transport().open_session()
+        try:
+            channel.exec_command(command)
+            stdout, truncated = read_capped(channel.recv, max_bytes)
+            
+            if truncated:
+                # The command is still writing; closing the channel stops it
+                logger.warning("Output of %r truncated at %d bytes", command, max_bytes)
+                stderr = b''
+                exit_status = -1
+            else:
+                # stderr only matters when the command failed, skip it on success
+                exit_status = channel.recv_exit_status()
+                stderr = read_capped(channel.recv_stderr, max_bytes)[0] if exit_status else b''
+            
+            return exit_status, stdout.decode(errors='replace'), stderr.decode(errors='replace')
+        finally:
+            channel.close()
+
+def execute_ssh_command(ssh, command, max_bytes=SSH_MAX_OUTPUT):
+    """Run a command and return (stdout, error), error is empty only when the command exited with status 0"""
+    exit_status, stdout, stderr = run_ssh_command(ssh, command, max_bytes)
+    if exit_status != 0 and not stderr.strip():
+        # Silent failures and truncated output must not read as success to callers checking the error
+        if exit_status == -1:
+            stderr = f"Output exceeded {max_bytes} bytes or no exit status was returned"
+        else:
+            stderr = f"Command exited with status {exit_status}"
+    return stdout, stderr
+
+async def reap_dead_sessions():
+    """Periodically drop sessions whose transport has died"""
+    while True:
+        await asyncio.sleep(SSH_REAP_INTERVAL)
+        for server_id in list(active_sessions):
+            try:
+                transport = active_sessions[server_id].get_transport()
+                if transport and transport.is_active():
+                    continue
+            except Exception:
+                pass
+            logger.info("Reaping dead SSH session for %s", server_id)
+            close_ssh_session(server_id)
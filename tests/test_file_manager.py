@@ -0,0 +1,78 @@
+import asyncio
+import time
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from aiogram import Bot, Dispatcher
+
+import file_manager
+from file_manager import FileEntry, FileManagerState, init_file_manager
+
+SERVER_ID = 'a' * 24
+HOME = '/home/user'
+USER_ID = 42
+
+def make_dispatch():
+    """Register the file manager on a fresh dispatcher and return its callback entry point"""
+    bot = Bot(token='123456:TEST-token_for_handler_checks')
+    dp = Dispatcher(bot)
+    init_file_manager(dp, bot, {}, {})
+    for handler_obj in dp.callback_query_handlers.handlers:
+        if handler_obj.handler.__name__ == 'file_manager_dispatch':
+            return handler_obj.handler
+    raise AssertionError("file_manager_dispatch was not registered")
+
+def make_callback(data):
+    callback = MagicMock()
+    callback.data = data
+    callback.from_user.id = USER_ID
+    callback.answer = AsyncMock()
+    callback.message.message_id = 1
+    callback.message.reply_markup = None
+    callback.message.edit_text = AsyncMock()
+    callback.message.answer = AsyncMock()
+    return callback
+
+async def tap(dispatch, data):
+    callback = make_callback(data)
+    await dispatch(callback)
+    # Handlers run on the user's queue, wait for it to drain
+    while USER_ID in file_manager.user_queues:
+        await asyncio.sleep(0)
+    return callback
+
+def test_select_mode_redraws_from_cached_listing():
+    async def run():
+        dispatch = make_dispatch()
+        file_manager.file_manager_state[USER_ID] = FileManagerState(server_id=SERVER_ID, current_path=HOME, home_path=HOME)
+        file_manager.listing_cache[(SERVER_ID, HOME)] = (time.monotonic(), [FileEntry('notes.txt', False, 'notes.txt', 'notes.txt')])
+        
+        callback = await tap(dispatch, f"fm_select_mode_{SERVER_ID}")
+        
+        assert file_manager.file_manager_state[USER_ID].selection_mode
+        callback.message.edit_text.assert_awaited_once()
+        kb = callback.message.edit_text.await_args.kwargs['reply_markup']
+        callback_data = [button.callback_data for row in kb.inline_keyboard for button in row]
+        assert f"fm_toggle_{SERVER_ID}_notes.txt" in callback_data
+    
+    try:
+        asyncio.run(run())
+    finally:
+        file_manager.file_manager_state.pop(USER_ID, None)
+        file_manager.listing_cache.pop((SERVER_ID, HOME), None)
+        file_manager.last_callback.pop(USER_ID, None)
+
+def test_colliding_file_name_hashes_keep_both_names():
+    def colliding_hash(filename, salt=0):
+        return 'c' * 13 if not salt else f"{salt:013d}"
+    
+    first, second = 'first_long_file_name.txt', 'second_long_file_name.txt'
+    try:
+        with patch.object(file_manager, 'get_file_hash', side_effect=colliding_hash):
+            first_token = file_manager.cache_filename(first)
+            second_token = file_manager.cache_filename(second)
+        assert first_token != second_token
+        assert file_manager.get_cached_filename(first_token) == first
+        assert file_manager.get_cached_filename(second_token) == second
+    finally:
+        file_manager.file_name_cache.pop('c' * 13, None)
+        file_manager.file_name_cache.pop(f"{1:013d}", None)